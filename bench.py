@@ -0,0 +1,261 @@
+#!/usr/bin/python3
+#
+# Benchmarks for the ChanServ helper script on large synthetic channels
+#
+# Every scenario replays synthetic server traffic through chanserv.1.py on
+# fakexchat and reports, per scenario: wall time, time per hook and per
+# hot function (Action.match, Action.parse_bans, ...), peak and retained
+# traced memory and allocated blocks, and the number of lines the script
+# sent.
+#
+#   python3 bench.py                  # all scenarios
+#   python3 bench.py unban matches    # some of them
+#   python3 bench.py --json           # machine readable, for comparisons
+#
+# This script is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# version 3, as published by the Free Software Foundation.
+
+import argparse
+import contextlib
+import gc
+import io
+import json
+import time
+import tracemalloc
+
+import replay
+
+# Functions of the script timed separately from the hooks
+hot_functions = ['Action.match', 'Action.parse_bans', 'Action.parse_whos', 'Action.run',
+                 'Action.resolve_nick', 'wake', 'get_ipaddr']
+
+def profile_functions(plugin, names, times):
+    """Wrap functions of the script to record [calls, seconds] in times"""
+    for name in names:
+        owner, attr = plugin, name
+        if '.' in name:
+            cls, attr = name.split('.')
+            owner = getattr(plugin, cls, None)
+        func = getattr(owner, attr, None) if owner else None
+        if not func:
+            continue
+        times[name] = [0, 0.0]
+        setattr(owner, attr, timed(func, times[name]))
+
+def timed(func, entry):
+    def wrapper(*args, **kwargs):
+        entry[0] += 1
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            entry[1] += time.perf_counter() - start
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+def whois_lines(nick, ident, host, name='Synthetic user', account=None):
+    lines = [':srv 311 me %s %s %s * :%s' % (nick, ident, host, name)]
+    if account:
+        lines.append(':srv 330 me %s %s :is logged in as' % (nick, account))
+    lines.append(':srv 318 me %s :End of /WHOIS list.' % nick)
+    return lines
+
+def ban_lines(channel, nbans, nquiets, nakicks, now=1400000000):
+    """A ban, quiet and AKICK list burst; every tenth ban and quiet and the
+    first AKICK match victim!~v@10.0.0.1"""
+    lines = []
+    for i in range(nbans):
+        mask = '*!*@10.0.0.1$#fwd%d' % i if i % 10 == 0 else '*!*@192.0.%d.%d' % (i // 256, i % 256)
+        lines.append(':srv 367 me %s %s op!op@staff %d' % (channel, mask, now - i))
+    lines.append(':srv 368 me %s :End of Channel Ban List' % channel)
+    for i in range(nquiets):
+        mask = '*!*@10.0.0.1$#fwd%d' % i if i % 10 == 0 else '*!*@198.51.%d.%d' % (i // 256, i % 256)
+        lines.append(':srv 728 me %s q %s op!op@staff %d' % (channel, mask, now - i))
+    lines.append(':srv 729 me %s q :End of Channel Quiet List' % channel)
+    if nakicks:
+        cs = ':ChanServ!ChanServ@services. NOTICE me :'
+        lines.append(cs + 'AKICK list for \x02%s\x02:' % channel)
+        for i in range(nakicks):
+            mask = '*!*@10.0.0.1' if i == 0 else '*!*@203.0.%d.%d' % (i // 256, i % 256)
+            lines.append(cs + '%d: \x02%s\x02 (spam) [setter: op, expires: never, modified: 1h ago]' % (i + 1, mask))
+        lines.append(cs + "Total of \x02%d\x02 entries in \x02%s\x02's AKICK list." % (nakicks, channel))
+    return lines
+
+def whox_lines(channel, nusers):
+    """A WHOX burst; two thirds of the users are logged in"""
+    lines = [':srv 354 me %s ~i%d 10.%d.%d.%d u%d %s :Synthetic user %d' %
+             (channel, i % 97, i % 3, i // 256 % 256, i % 256, i, 'acct%d' % i if i % 3 else '0', i)
+             for i in range(nusers)]
+    lines.append(':srv 315 me %s :End of /WHO list.' % channel)
+    return lines
+
+def op_line(channel):
+    return ':ChanServ!ChanServ@services. MODE %s +o me' % channel
+
+def scenario_unban(r):
+    """/cs unban against 500 bans, 200 quiets and 300 AKICKs"""
+    r.plugin.can_do_akick['freenode'].add('#big')
+    r.xchat.add_channel('#big', ['victim'])
+    r.command('/cs unban victim', '#big')
+    for line in whois_lines('victim', '~v', '10.0.0.1') + ban_lines('#big', 500, 200, 300) + [op_line('#big')]:
+        r.server(line)
+
+def scenario_warm(r):
+    """/cs unban as in unban, after warming the caches up on join"""
+    r.plugin.can_do_akick['freenode'].add('#big')
+    r.server(':me!~me@host JOIN #big')
+    r.xchat.add_channel('#big', ['victim'])
+    for line in ban_lines('#big', 500, 200, 300) + whox_lines('#big', 1):
+        r.server(line)
+    r.xchat.advance(120)
+    r.command('/cs unban victim', '#big')
+    for line in whois_lines('victim', '~v', '10.0.0.1') + [op_line('#big')]:
+        r.server(line)
+
+def scenario_matches(r):
+    """/cs matches on a 5,000 user WHOX burst"""
+    r.xchat.add_channel('#big')
+    r.command('/cs matches *!*@10.1.*', '#big')
+    for line in whox_lines('#big', 5000):
+        r.server(line)
+
+def scenario_clones(r):
+    """/cs clones on a 5,000 user WHOX burst, then again on the warm roster"""
+    r.xchat.add_channel('#big')
+    r.command('/cs clones', '#big')
+    for line in whox_lines('#big', 5000):
+        r.server(line)
+    r.command('/cs clones 2', '#big')
+
+def scenario_kb_flood(r):
+    """Ten concurrent /cs kb during a 2,000 user join flood"""
+    r.xchat.add_channel('#big', ['bot%d' % i for i in range(10)])
+    for i in range(10):
+        r.command('/cs kb bot%d flooding' % i, '#big')
+    joins = [':j%d!~j@10.9.%d.%d JOIN #big' % (i, i // 256, i % 256) for i in range(2000)]
+    step = len(joins) // 10
+    for i in range(10):
+        for line in joins[i * step:(i + 1) * step]:
+            r.server(line)
+        for line in whois_lines('bot%d' % i, '~b', '10.8.0.%d' % i):
+            r.server(line)
+    for line in ban_lines('#big', 100, 0, 0) + [op_line('#big')]:
+        r.server(line)
+
+def scenario_flood(r):
+    """Flood detection on 20,000 lines of chatter from 2,000 users and one flooder"""
+    r.plugin.flood_channels.append('#big')
+    r.plugin.watch_channels()
+    r.xchat.add_channel('#big', ['u%d' % i for i in range(2000)] + ['flooder'])
+    for i in range(20000):
+        r.server(':u%d!~u@10.2.%d.%d PRIVMSG #big :line %d' % (i % 2000, i % 2000 // 256, i % 256, i))
+        if i % 100 == 50:
+            r.server(':flooder!~f@10.3.0.1 PRIVMSG #big :FLOOD')
+        r.xchat.advance(0.05)
+
+def scenario_lockdown(r):
+    """Join rate tracking on 30,000 joins over 300 watched channels, one of them flooded"""
+    channels = ['#c%d' % i for i in range(300)]
+    r.plugin.lockdown_channels.update(channels)
+    r.plugin.watch_channels()
+    for channel in channels:
+        r.xchat.add_channel(channel)
+    for i in range(30000):
+        r.server(':j%d!~j@10.4.%d.%d JOIN %s' % (i, i // 256 % 256, i % 256, channels[i % 300]))
+        if i % 3 == 0:
+            r.server(':bot%d!~b@10.5.%d.%d JOIN #c0' % (i, i // 256 % 256, i % 256))
+        r.xchat.advance(0.01)
+
+def scenario_ingest(r):
+    """Ban list ingestion: 5,000 bans, 2,000 quiets and 1,000 AKICKs via /cs bans"""
+    r.plugin.can_do_akick['freenode'].add('#big')
+    r.xchat.add_channel('#big')
+    r.command('/cs bans', '#big')
+    for line in ban_lines('#big', 5000, 2000, 1000):
+        r.server(line)
+    # Let the listing stream out
+    r.xchat.advance(60)
+
+def scenario_memory(r):
+    """Cached lists: 50,000 bans via /cs compact check and a 20,000 user roster"""
+    r.xchat.add_channel('#big')
+    r.command('/cs compact check', '#big')
+    for line in ban_lines('#big', 50000, 0, 0):
+        r.server(line)
+    r.command('/cs matches *!*@10.1.*', '#big')
+    for line in whox_lines('#big', 20000):
+        r.server(line)
+
+def scenario_startup(r):
+    """Loading the script 20 times, then 19,000 Whois, Who and ban list replies to other clients' queries"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(20):
+            replay.fakexchat.load_plugin(replay.fakexchat.FakeXChat(), r.plugin.__file__)
+    for i in range(2000):
+        nick = 'u%d' % i
+        for line in whois_lines(nick, '~u', '10.6.%d.%d' % (i // 256, i % 256), account=nick):
+            r.server(line)
+    for line in whox_lines('#other', 10000) + ban_lines('#other', 2000, 1000, 0):
+        r.server(line)
+
+scenarios = [('unban', scenario_unban), ('warm', scenario_warm), ('matches', scenario_matches),
+             ('clones', scenario_clones), ('kb_flood', scenario_kb_flood),
+             ('flood', scenario_flood), ('lockdown', scenario_lockdown), ('ingest', scenario_ingest),
+             ('memory', scenario_memory), ('startup', scenario_startup)]
+
+def run(scenario, script=None):
+    """Run a scenario twice: once timed, once under tracemalloc"""
+    r = replay.Replay(script)
+    times = {}
+    profile_functions(r.plugin, hot_functions, times)
+    gc.collect()
+    start = time.perf_counter()
+    scenario(r)
+    elapsed = time.perf_counter() - start
+    result = {'wall_ms': elapsed * 1000, 'lines_in': r.lines_in, 'lines_sent': len(r.xchat.sent),
+              'lines_printed': len(r.xchat.printed),
+              'hooks': dict((k, {'calls': c, 'us': s * 1e6}) for k, (c, s) in r.xchat.hook_times.items()),
+              'functions': dict((k, {'calls': c, 'us': s * 1e6}) for k, (c, s) in times.items() if c)}
+
+    r = replay.Replay(script, profile=False)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    scenario(r)
+    after = tracemalloc.take_snapshot()
+    result['retained_kib'], result['peak_kib'] = [size / 1024.0 for size in tracemalloc.get_traced_memory()]
+    tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    result['alloc_blocks'] = sum(s.count_diff for s in stats if s.count_diff > 0)
+    return result
+
+def report(name, doc, result, out=print):
+    out('== %s: %s' % (name, doc))
+    out('   %.1f ms wall, %d lines in, %d lines sent, %d lines printed, peak %.0f KiB, retained %.0f KiB, %d blocks' %
+        (result['wall_ms'], result['lines_in'], result['lines_sent'], result['lines_printed'],
+         result['peak_kib'], result['retained_kib'], result['alloc_blocks']))
+    for kind in ('hooks', 'functions'):
+        for key, entry in sorted(result[kind].items(), key=lambda x: -x[1]['us']):
+            out('   %-9s %-28s %7d calls %10.0f us %8.2f us/call' %
+                (kind[:-1], key, entry['calls'], entry['us'], entry['us'] / entry['calls']))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the script on large synthetic channels')
+    parser.add_argument('scenario', nargs='*', help='scenarios to run (default: all)')
+    parser.add_argument('--script', default=None, help='path to the script (default: chanserv.1.py)')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name, scenario in scenarios:
+        if args.scenario and name not in args.scenario:
+            continue
+        results[name] = run(scenario, args.script)
+        if not args.json:
+            report(name, scenario.__doc__, results[name])
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+if __name__ == '__main__':
+    main()
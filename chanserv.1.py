@@ -37,9 +37,11 @@
 #   d,  deop     - Deop yourself or someone else (/cs deop [channel] [nick])
 #   dv, devoice  - Devoice yourself or someone else (/cs devoice [channel] [nick])
 #   i,  info     - Print user info (/cs info [nick])
-#   bs, bans     - List bans for a user or all (/cs bans [channel] [nick])
+#   bs, bans     - List bans for a user or all (/cs bans [channel] [filters] [nick])
 #   ms, matches  - Lists users matching a mask (/cs matches [channel] <mask>)
 #   x,  access   - Get or set access rights for a channel (/cs access [channel] [args])
+#   lat, latency - Print action latency histogram and recent results (/cs latency)
+#   st, stats    - Print queue, wait, cache, traffic, hook and startup statistics (/cs stats)
 #
 # To op yourself, perform an action, and deop:
 #
@@ -60,38 +62,89 @@
 #   t,  topic    - Get or set channel topic (/cs topic [channel] [topic])
 #   m,  mode     - Get or set channel modes (/cs mode [channel] [modes])
 #   iv, invite   - Invite yourself or someone else (/cs invite [channel] [nick])
+#   cp, compact  - Remove bans and quiets covered by broader ones, or only list
+#                   them with 'check' (/cs compact [channel] [check])
+#   sy, sync     - Make the ban, quiet and AKICK lists match a file (/cs sync [channel] <file>)
+#   cl, clones   - List users sharing a host, IP address, /24 or /64 network or
+#                   gateway ident, and ban them with 'ban' (/cs clones [channel] [min] [ban])
 #
 # * Bans, forwards and mutes take an extra optional argument that specifies what
 #   should be banned: nick, ident, host, full mask, account and/or realname.
 #     /cs ban -nah <nick> -- Ban nick, account and host
 #     /cs forward -nuhfiarx <nick> <channel> -- Forward all
 #
+# * Any command can be run on several channels at once with -c and a comma
+#   separated list of channels or names of channel_groups. The target is
+#   looked up once and the changes go out through one paced queue.
+#     /cs ban -c #a,#b,#c <nick> -- Ban nick in three channels
+#     /cs kb -c family <nick> -- Kickban nick in a group of channels
+#
+# * Bans, mutes and kicks take -A to act on an account instead of a nick:
+#   every user in the channel logged in as it is kicked, and $a: is banned.
+#     /cs kb -A <account> [comment] -- Kickban all nicks of an account
+#
 # * These commands also take an extra argument to specify
 #   when bans/mutes should be lifted automatically.
 #     /cs ban -t10 <nick> -- Ban nick for 10 minutes
 #     /cs ban -nah -t60 <nick> -- Ban nick, account and host for an hour
 #
+# * Bans takes filters, and prints long lists a few entries at a time:
+#     type=b,q,akick -- Only these lists
+#     setter=<text>, match=<text> -- Setter or mask/AKICK entry contains text
+#     older=<age>, newer=<age> -- Set before or within age (30m, 12h, 7d, 2w)
+#     sort=date|mask|setter -- Sort order, '-date' for newest first
+#     file=<file> -- Write the list to a file (relative to the XChat directory)
+#   e.g. /cs bans type=b older=30d sort=date file=oldbans.txt
+#
 # * Unban will remove all bans matching the nick or mask.
 #   you give as argument (*  and ? wildcards work)
+#   $j:#channel bans match when the user is banned in #channel, whose
+#   ban list is fetched as needed.
 
 # * It won't actually kick, but use the /remove command.
 #
+# * Sync files (relative to the XChat directory) have one entry per line:
+#   'b <mask>', 'q <mask>' or 'akick <mask> [reason]'; lines starting with
+#   '#' are comments.
+#   Only the lists that appear in the file are synced; a line with just 'b',
+#   'q' or 'akick' syncs that list to empty.
+#
 # * The following additional features are implemented:
 #    - Auto-rejoin for /remove
 #    - Auto-unban
 #    - Auto-unmute
 #    - Auto-invite
 #    - Auto-getkey
+#    - Making room on full ban lists (see full_list_policy)
+#    - Fetching the lists and Who list of channels where we have ChanServ
+#      access in the background, ahead of the first command (see warm_caches)
+#    - Timed quiets for floods on the channels in flood_channels
+#    - Lockdown on join floods for the channels in lockdown_channels
+#    - Quiet mode, MODE batching, WHOX and case mapping taken from the
+#      server's ISUPPORT tokens, remembered per network (capabilities_file)
 
 __module_name__        = 'ChanServ'
 __module_version__     = '3.3.0'
 __module_description__ = 'ChanServ helper'
 
 import collections
+import itertools
+import json
 import xchat
+import os
 import time
+import math
 import re
 
+try:
+    from sys import intern
+except ImportError:
+    pass
+
+# Load time (perf_counter seconds), shown by /cs stats
+load_started = time.perf_counter()
+load_time = None
+
 # Event queue
 pending = []
 # Whois cache
@@ -101,19 +154,107 @@ resolving_users = []
 bans = collections.defaultdict(list)
 quiets = collections.defaultdict(list)
 akicks = collections.defaultdict(list)
+# Masks on those lists by mask_key(), for duplicate checks
+ban_keys = collections.defaultdict(dict)
+quiet_keys = collections.defaultdict(dict)
+akick_keys = collections.defaultdict(dict)
+# When the ban and quiet lists of a channel were fetched; they are used for
+# ban_cache_ttl seconds, or while we stay in joined_channels, with bans and
+# quiets seen being set added, and dropped when an entry is removed or we
+# leave or join the channel again
+ban_stamps = {}
+ban_cache_ttl = 60
+joined_channels = set()
 collecting_bans = []
+collecting_quiets = []
+# Entry counts of the exception (+e) and invite (+I) lists sharing MAXLIST
+# with bans, by channel and mode; fetched once opped when making room, and
+# kept like the ban lists. When a list sharing the limit cannot be counted,
+# a new ban within list_margin entries of it gets a warning instead
+list_counts = collections.defaultdict(dict)
+count_stamps = {}
+collecting_counts = {}
+list_margin = 10
+# When the AKICK list of a channel was fetched; it is kept current with
+# ChanServ's replies to our changes, and fetched again after akick_cache_ttl
+# seconds for the changes of others
+akick_stamps = {}
+akick_cache_ttl = 3600
+collecting_akicks = []
 current_akick = None
-# Who cache
+# Reasons of the AKICKs we added, by channel and mask_key(), until ChanServ
+# confirms them
+akicks_sent = {}
+# Who cache, by channel and folded nick
 whos = {}
 collecting_whos = []
-# Access rights
-can_do_akick = []
-can_do_topic = []
-collecting_access = []
+# Account index of channels with a Who list: members by folded account and
+# nick, and the folded account of each member (None if not logged in); kept
+# current, like the Who list, with JOIN (extended-join), ACCOUNT
+# (account-notify), NICK, PART, KICK and QUIT, and dropped when we connect
+# or join the channel again. Members whose account is not known (plain JOIN
+# or WHO) are in unknown_accounts, and -A asks for the Who list again while
+# there are any, without account-notify, or unless it came from WHOX
+account_members = {}
+member_accounts = {}
+unknown_accounts = collections.defaultdict(set)
+whox_rosters = set()
+# Access rights: channels where we may edit the AKICK list (+f) and set the
+# topic (+t), by network. Saved to access_file (relative to the XChat
+# directory) by network and account, and asked from NickServ again only
+# when older than access_ttl seconds or when ChanServ refuses us
+can_do_akick = collections.defaultdict(set)
+can_do_topic = collections.defaultdict(set)
+access_file = 'chanserv.access'
+access_ttl = 86400
+# (akick, topic) sets of listings in progress, and our accounts, by network
+collecting_access = {}
+logged_in = {}
+# Networks whose saved channel access was stale at load; it is used until
+# NickServ, asked by the first /cs command there, lists it again
+access_deferred = set()
 
 kick_message = 'Goodbye'
 akick_message = ''
 
+# Server capabilities by network: ISUPPORT tokens ('isupport') and enabled
+# CAP capabilities ('cap'); saved to capabilities_file (relative to the XChat
+# directory) once connected, and used until the server sends them again
+capabilities = {}
+capabilities_file = 'chanserv.caps'
+# When a ban would overflow the list (MAXLIST): move the oldest bans to the
+# AKICK list ('akick', where allowed, else expire them), remove the oldest
+# ones ('expire'), or only warn ('warn')
+full_list_policy = 'akick'
+
+# Per-stage deadlines (seconds), retries and sweeper interval (ms)
+stage_deadlines = {'resolve': 10, 'sync': 15, 'op': 10}
+stage_retries = 2
+sweep_interval = 1000
+sweeper = None
+# Action latency histogram (upper bounds in seconds) and recent results
+latency_buckets = [0.5, 1, 2, 5, 10, 30, 60]
+latencies = [0] * (len(latency_buckets) + 1)
+results = collections.deque(maxlen=20)
+# Statistics: stage waits [count, total, max], cache [hits, misses] by wait kind,
+# lines sent by command, hook [calls, seconds]; dumped to stats_file (relative
+# to the XChat directory) every stats_interval seconds if set
+stage_waits = dict((stage, [0, 0.0, 0.0]) for stage in stage_deadlines)
+cache_stats = {'whois': [0, 0], 'bans': [0, 0], 'whos': [0, 0]}
+lines_sent = collections.defaultdict(int)
+hook_times = {}
+stats_file = None
+stats_interval = 60
+# Hooks for server replies by kind ('whois', 'bans', 'whos'): registered at
+# load, but only hooked while replies of that kind are being collected. The
+# flood and join counters ('flood', 'lockdown') are only hooked while
+# flood_channels and lockdown_channels are not empty
+reply_hooks = collections.defaultdict(list)
+reply_handles = {}
+# /cs bans output: entries printed per timer tick, and the tick interval (ms)
+list_chunk = 50
+list_interval = 100
+
 atheme_networks = ['freenode']
 remove_networks = ['freenode']
 quiet_networks = ['freenode', 'oftc']
@@ -123,10 +264,52 @@ commands = {'k': 'kick', 'r': 'remove', 'b': 'ban', 'kb': 'kickban',
             'l': 'lart', 'a': 'akick', 'q': 'quiet', 'mute': 'quiet',
             'u': 'unban', 'o': 'op', 'd': 'deop', 'v': 'voice', 'dv': 'devoice',
             'i': 'info', 'bs': 'bans', 'ms': 'matches', 'x': 'access',
-            't': 'topic', 'm': 'mode', 'iv': 'invite'}
+            't': 'topic', 'm': 'mode', 'iv': 'invite', 'lat': 'latency',
+            'st': 'stats', 'cp': 'compact', 'sy': 'sync', 'cl': 'clones'}
 op_commands = ['op', 'deop', 'voice', 'devoice']
 kick_commands = ['kick', 'remove', 'kickban', 'kickforward', 'lart']
 ban_commands = ['ban', 'kickban', 'forward', 'kickforward', 'lart', 'akick', 'quiet']
+# Mode changes per MODE line where the server does not tell (MODES), and
+# the longest MODE line to send; lines sent at once and per second after
+# that by paced actions (sync, -c)
+modes_per_line = 4
+max_mode_line = 400
+queue_burst = 5
+queue_rate = 1.0
+# Fetch the ban, quiet and AKICK lists and the Who list of channels where we
+# have ChanServ access (can_do_akick, can_do_topic) when we join them, get
+# opped there or learn our access, so that the first /cs command finds them
+# cached; paced by the outbox, and dropped when a /cs command starts
+warm_caches = True
+# Named groups of channels for -c
+channel_groups = {}
+# Smallest group of users /cs clones lists
+clone_minimum = 3
+# Flood protection for the channels in flood_channels (none by default):
+# quiet a host for flood_quiet minutes once it sends flood_lines[0] lines,
+# or joins or changes nick flood_joins[0] times, within flood_lines[1]
+# (flood_joins[1]) seconds, or sends a message that flood_repeats[0] lines
+# within flood_repeats[1] seconds had
+flood_channels = []
+flood_lines = (6, 4)
+flood_joins = (4, 30)
+flood_repeats = (4, 20)
+flood_quiet = 10
+# Event times of the last flood_*[0] events by (kind, channel, host or
+# message hash), and when the hosts quieted for a flood may flood again
+flood_rings = {}
+flood_quieted = {}
+flood_pruner = None
+# Join flood lockdown for the channels in the set lockdown_channels: set
+# lockdown_modes once lockdown_joins[0] users join within lockdown_joins[1]
+# seconds, and unset them after lockdown_period seconds without that rate
+lockdown_channels = set()
+lockdown_joins = (8, 4)
+lockdown_modes = '+r'
+lockdown_period = 300
+# Join rates by channel, and the last time locked channels got flooded
+join_rates = {}
+lockdowns = {}
 forward_commands = ['forward', 'kickforward']
 
 def cs(word, word_eol, userdata):
@@ -135,12 +318,6 @@ def cs(word, word_eol, userdata):
         print("No command specified.")
         return xchat.EAT_ALL
 
-    # Reset on every run
-    del pending[:]
-    del resolving_users[:]
-    del collecting_bans[:]
-    del collecting_whos[:]
-
     command = word[1].lower()
 
     if command in list(commands.keys()):
@@ -148,8 +325,38 @@ def cs(word, word_eol, userdata):
     elif command not in list(commands.values()):
         return xchat.EAT_NONE
 
+    # Run once per channel for -c, taken only from the options before the
+    # target (mode changes like -c are arguments of 'mode')
+    i = 2
+    while command != 'mode' and i < len(word) and word[i].startswith('-'):
+        if word[i] != '-c':
+            i += 1
+            continue
+        if i + 1 == len(word):
+            print("No channels given for -c.")
+            return xchat.EAT_ALL
+        channels = []
+        for name in word[i + 1].split(','):
+            for channel in channel_groups.get(name, [name]):
+                if channel not in channels:
+                    channels.append(channel)
+        for channel in channels:
+            cs(word[:2] + [channel] + word[2:i] + word[i + 2:], None, 'paced')
+        return xchat.EAT_ALL
+
+    if command == 'latency':
+        print_latency()
+        return xchat.EAT_ALL
+    elif command == 'stats':
+        for line in format_stats():
+            xchat.emit_print('Server Text', line)
+        return xchat.EAT_ALL
+
     server = xchat.get_info('server')
-    network = server.split('.')[-2]
+    network = network_name(server)
+    if network in access_deferred:
+        access_deferred.discard(network)
+        refresh_access(network)
 
     # Get channel
     if command != 'info':
@@ -194,6 +401,8 @@ def cs(word, word_eol, userdata):
 
     action = Action(channel = channel, server = server, network = network,
                     me = xchat.get_info('nick'), context = context)
+    action.command = command
+    action.paced = userdata == 'paced'
 
     # Check for options
     if command != 'mode':
@@ -203,12 +412,50 @@ def cs(word, word_eol, userdata):
                     action.bans += arg[1:]
                 elif re.match(r'^-t[0-9]+$', arg):
                     action.timer = int(arg[2:])
+                elif arg == '-A':
+                    action.by_account = True
                 args.remove(arg)
             else:
                 break
 
+    # Listing filters
+    if command == 'bans':
+        action.listing = {}
+        for arg in args[:]:
+            key, sep, value = arg.partition('=')
+            if not sep:
+                continue
+            if key in ('older', 'newer'):
+                value = parse_duration(value)
+                if value is None:
+                    print("Invalid age: '%s'" % arg)
+                    return xchat.EAT_ALL
+            elif key == 'type':
+                value = value.lower().split(',')
+                if not set(value) <= set(('b', 'q', 'akick')):
+                    print("Invalid type: '%s'" % arg)
+                    return xchat.EAT_ALL
+            elif key == 'sort':
+                if value.lstrip('-') not in ('date', 'mask', 'setter'):
+                    print("Invalid sort order: '%s'" % arg)
+                    return xchat.EAT_ALL
+            elif key not in ('setter', 'match', 'file'):
+                print("Unknown filter: '%s'" % key)
+                return xchat.EAT_ALL
+            action.listing[key] = value
+            args.remove(arg)
+
     # Get target
-    if args and command not in ('access', 'topic', 'mode'):
+    if action.by_account:
+        if command not in ban_commands and command not in kick_commands:
+            print("-A only works with ban and kick commands.")
+            return xchat.EAT_ALL
+        elif not args:
+            print("No account given.")
+            return xchat.EAT_ALL
+        action.target = action.target_account = args[0]
+        action.bans = 'a'
+    elif args and command not in ('access', 'topic', 'mode', 'compact', 'sync', 'clones'):
         action.target = args[0]
         if re.match(r'^[a-zA-Z_^`|\\[\]{}][-a-zA-Z0-9_^`|\\[\]{}]{0,16}$', action.target):
             action.target_nick = action.target
@@ -261,7 +508,7 @@ def cs(word, word_eol, userdata):
         action.needs_op = False
         if not action.target_nick:
             action.target_nick = action.me
-        action.actions.append('ChanServ %s %%(channel)s %%(target_nick)s' % command)
+        action.actions.append(Op('ChanServ ' + command, args=action.target_nick))
 
     elif command == 'info':
         action.needs_op = False
@@ -274,38 +521,61 @@ def cs(word, word_eol, userdata):
         action.do_matches = True
         action.needs_op = False
 
+    elif command == 'compact':
+        action.do_compact = True
+        if args and args[0] == 'check':
+            action.compact_check = True
+            action.needs_op = False
+
+    elif command == 'clones':
+        action.do_clones = True
+        action.clone_min = clone_minimum
+        for arg in args:
+            if arg.isdigit() and int(arg) > 1:
+                action.clone_min = int(arg)
+            elif arg == 'ban':
+                action.clone_ban = True
+            else:
+                print("Invalid argument: '%s'" % arg)
+                return xchat.EAT_ALL
+        action.needs_op = action.clone_ban
+
+    elif command == 'sync' and args:
+        action.sync = read_sync_file(args[0], casemapping(action.network))
+        if action.sync is None:
+            return xchat.EAT_ALL
+        if 'akick' in action.sync and action.channel not in can_do_akick[action.network]:
+            xchat.emit_print('Server Error', 'No access to the AKICK list of %s, not syncing it.' % action.channel)
+            del action.sync['akick']
+        action.paced = True
+
     elif command == 'access':
         action.needs_op = False
-        if not args:
-            action.actions.append('ChanServ access %(channel)s list')
-        else:
-            action.actions.append('ChanServ access %%(channel)s %s' % ' '.join(args))
+        action.actions.append(Op('ChanServ access', args=' '.join(args) or 'list'))
 
     elif command == 'topic':
         if not args:
             action.needs_op = False
-            action.actions.append('topic %(channel)s')
-        elif action.channel in can_do_topic:
+            action.actions.append(Op('topic'))
+        elif action.channel in can_do_topic[action.network]:
             action.needs_op = False
-            action.actions.append('ChanServ topic %%(channel)s %s' % ' '.join(args))
+            action.actions.append(Op('ChanServ topic', args=' '.join(args)))
         else:
-            action.actions.append('topic %%(channel)s %s' % ' '.join(args))
+            action.actions.append(Op('topic', args=' '.join(args)))
 
     elif command == 'mode':
         if not args:
             action.needs_op = False
-            action.actions.append('mode %(channel)s')
-        else:
-            if re.match(r'^\+?[bq]+$', ' '.join(args)):
-                action.needs_op = False
-            action.actions.append('mode %%(channel)s %s' % ' '.join(args))
+        elif re.match(r'^\+?[bq]+$', ' '.join(args)):
+            action.needs_op = False
+        action.actions.append(Op('mode', args=' '.join(args)))
 
     elif command == 'invite':
         if not action.target_nick:
             action.needs_op = False
-            action.actions.append('ChanServ invite %(channel)s')
+            action.actions.append(Op('ChanServ invite'))
         else:
-            action.actions.append('invite %(target_nick)s %(channel)s')
+            action.actions.append(Op('invite', args=action.target_nick))
 
     # Usage check
     elif not args or (command in forward_commands and (len(args) < 2 and not action.forward_to)):
@@ -333,63 +603,28 @@ def cs(word, word_eol, userdata):
                 return xchat.EAT_ALL
 
         elif command == 'quiet':
-            if action.network in quiet_networks:
-                action.banmode = 'q'
+            mode, prefix = quiet_mode(action.network)
+            if mode:
+                action.banmode, action.quiet_prefix = mode, prefix
             else:
                 print("Network does not support quiets.")
 
         elif command == 'akick':
-            if action.channel in can_do_akick:
+            if action.channel in can_do_akick[action.network]:
                 action.do_akick = True
             elif action.network not in atheme_networks:
                 print("Network does not support AKICK.")
             else:
                 print("Insufficient access rights for AKICK.")
 
-        elif action.timer and action.channel in can_do_akick \
+        elif action.timer and action.channel in can_do_akick[action.network] \
                 and not (action.bans == 'f' and action.target_mask.startswith('$')):
             action.do_akick = True
 
-        # Schedule bans
-        if not action.do_akick:
-            if 'f' in action.bans:
-                action.actions.append('mode %(channel)s +%(banmode)s %(target_maskm)s%(forward_to)s')
-            if 'n' in action.bans:
-                action.actions.append('mode %(channel)s +%(banmode)s %(target_nick)s!*@*%(forward_to)s')
-            if 'u' in action.bans:
-                action.actions.append('mode %(channel)s +%(banmode)s *!%(target_identm)s@*%(forward_to)s')
-            if 'h' in action.bans:
-                action.actions.append('mode %(channel)s +%(banmode)s *!*@%(target_host)s%(forward_to)s')
-            if 'i' in action.bans:
-                action.actions.append('mode %(channel)s +%(banmode)s *!*@%(target_ipaddrm)s%(forward_to)s')
-            if 'a' in action.bans:
-                action.actions.append('mode %(channel)s +%(banmode)s $a:%(target_account)s%(forward_to)s')
-            if 'r' in action.bans:
-                action.actions.append('mode %(channel)s +%(banmode)s $r:%(target_name_bannable)s%(forward_to)s')
-            if 'x' in action.bans:
-                action.actions.append('mode %(channel)s +%(banmode)s $x:%(target_nick)s!%(target_identm)s@%(target_host)s#%(target_name_bannable)s%(forward_to)s')
-
-        # Schedule AKICKs
-        else:
-            action.reason = ' '.join(args[1:]) or akick_message
-            if action.timer:
-                action.akick_opts = '!t %d' % action.timer
-            if 'f' in action.bans:
-                action.actions.append('ChanServ akick %(channel)s add %(target_maskm)s %(akick_opts)s %(reason)s')
-            if 'n' in action.bans:
-                action.actions.append('ChanServ akick %(channel)s add %(target_nick)s!*@* %(akick_opts)s %(reason)s')
-            if 'u' in action.bans:
-                action.actions.append('ChanServ akick %(channel)s add *!%(target_identm)s@* %(akick_opts)s %(reason)s')
-            if 'h' in action.bans:
-                action.actions.append('ChanServ akick %(channel)s add *!*@%(target_host)s %(akick_opts)s %(reason)s')
-            if 'i' in action.bans:
-                action.actions.append('ChanServ akick %(channel)s add *!*@%(target_ipaddrm)s %(akick_opts)s %(reason)s')
-            if 'a' in action.bans:
-                action.actions.append('mode %(channel)s +%(banmode)s $a:%(target_account)s')
-            if 'r' in action.bans:
-                action.actions.append('mode %(channel)s +%(banmode)s $r:%(target_name_bannable)s')
-            if 'x' in action.bans:
-                action.actions.append('mode %(channel)s +%(banmode)s $x:%(target_nick)s!%(target_identm)s@%(target_host)s#%(target_name_bannable)s')
+        # Bans are planned once the target is resolved
+        if action.do_akick:
+            action.akick_opts = ' '.join(opt for opt in ('!t %d' % action.timer if action.timer else '',
+                                                         ' '.join(args[1:]) or akick_message) if opt)
 
     # Unban
     elif command == 'unban':
@@ -398,15 +633,26 @@ def cs(word, word_eol, userdata):
     # Schedule kick
     if command in kick_commands:
         action.reason = ' '.join(args[1:]) or kick_message
-        if action.network in remove_networks:
-            action.actions.append('remove %(channel)s %(target_nick)s %(reason)s')
+        if action.by_account:
+            pass
+        elif action.network in remove_networks:
+            action.actions.append(Op('remove', args='%s %s' % (action.target_nick, action.reason)))
         else:
-            action.actions.append('kick %(channel)s %(target_nick)s %(reason)s')
+            action.actions.append(Op('kick', args='%s %s' % (action.target_nick, action.reason)))
 
     return action.schedule()
 
 class Action(object):
     """A list of actions to do, and information needed for them"""
+    __slots__ = ('channel', 'server', 'network', 'me', 'me_curr', 'context', 'stamp', 'command', 'waited',
+                 'check_bans', 'am_op', 'deop', 'needs_op', 'do_ban', 'do_unban', 'do_bans', 'do_matches',
+                 'do_compact', 'compact_check', 'do_clones', 'clone_min', 'clone_ban', 'listing', 'sync', 'paced', 'room_actions', 'do_akick', 'needs_resolved',
+                 'resolved', 'by_account', 'task', 'target', 'target_nick', 'target_nickm', 'target_ident', 'target_identm',
+                 'target_host', 'target_mask', 'target_maskm', 'target_account', 'target_name',
+                 'target_name_bannable', 'target_ipaddr', 'target_ipaddrm', 'banmode', 'quiet_prefix',
+                 'forward_to', 'reason',
+                 'bans', 'planned', 'timer', 'akick_opts', 'actions')
+
     def __init__(self, channel, server, network, me, context):
         self.channel = channel
         self.server = server
@@ -415,6 +661,8 @@ class Action(object):
         self.me_curr = me
         self.context = context
         self.stamp = time.time()
+        self.command = None
+        self.waited = {}
 
         # Check existing bans first
         self.check_bans = True
@@ -427,11 +675,20 @@ class Action(object):
         self.do_unban = False
         self.do_bans = False
         self.do_matches = False
+        self.do_compact = False
+        self.compact_check = False
+        self.do_clones = False
+        self.clone_min = 0
+        self.clone_ban = False
+        self.listing = None
+        self.sync = None
+        self.paced = False
+        self.room_actions = []
         self.do_akick = False
         self.needs_resolved = False
         self.resolved = False
-        self.bans_parsed = False
-        self.whos_parsed = False
+        self.by_account = False
+        self.task = None
         self.target = ''
         self.target_nick = None
         self.target_nickm = None
@@ -446,9 +703,11 @@ class Action(object):
         self.target_ipaddr = None
         self.target_ipaddrm = None
         self.banmode = 'b'
+        self.quiet_prefix = ''
         self.forward_to = ''
         self.reason = ''
         self.bans = ''
+        self.planned = False
         self.timer = None
         self.akick_opts = ''
         self.actions = []
@@ -457,170 +716,340 @@ class Action(object):
         ctx = {'channel': self.channel, 'target': self.target}
         if hasattr(self, 'target_ident'):
             ctx['target'] = '%s (a: %s, r: %s)' % (self.target_mask, self.target_account, self.target_name)
-        ctx['actions'] = ' | '.join(self.actions)
+        ctx['actions'] = ' | '.join(op.render(self.channel) for op in self.actions)
         return 'C: %(channel)s T: %(target)s A: %(actions)s' % ctx
 
     def schedule(self, update_stamp=False):
-        """Request information and add ourselves to the queue"""
+        """Add ourselves to the queue and start working"""
         if update_stamp:
             self.stamp = time.time()
 
-        if self.do_unban or self.do_bans or (self.do_ban and self.check_bans):
-            collecting_bans.append(self.channel)
-        elif self.do_matches:
-            collecting_whos.append(self.channel)
-
+        cancel_warm_ups()
         pending.append(self)
-        run_pending()
+        self.task = spawn(self.steps(), self)
         return xchat.EAT_ALL
 
-    def resolve_nick(self):
-        """Try to find nick, ident and host"""
-        if self.target_nickm in users:
-            if users[self.target_nickm].time < time.time() - 10:
-                del users[self.target_nickm]
-                resolving_users.append(self.target_nickm)
-                self.context.command('whois %s' % self.target_nickm)
-            else:
-                self.target_ident = users[self.target_nickm].ident
-                self.target_identm = get_identm(self.target_ident)
-                self.target_host = users[self.target_nickm].host
-                self.target_mask = '%s!%s@%s' % (self.target_nick, self.target_ident, self.target_host)
-                self.target_maskm = '%s!%s@%s' % (self.target_nick, self.target_identm, self.target_host)
-                self.target_account = users[self.target_nickm].account
-                self.target_name = users[self.target_nickm].name
-                self.target_name_bannable = self.target_name.replace(r' ', '?')
-                self.target_ipaddr, self.target_ipaddrm = get_ipaddr(self.target_host)
-                self.resolved = True
-
-                xchat.emit_print('Server Text', '\x02%s\x02 (a: %s, r: %s)' %
-                    (self.target_mask, self.target_account, self.target_name))
-
-                if self.do_ban:
-                    # For gateway users, use different defaults
-                    if self.bans == 'h' and re.match('^(gateway/(shell|web)|conference|nat)/', self.target_host):
-                        if re.match(r'^gateway/web/freenode/', self.target_host):
-                            ban_mask = '*!*@%s' % self.target_ipaddr
-                        else:
-                            gateway = re.match(r'^((gateway/shell|conference|nat)/.+/|gateway/web/)', self.target_host)
-                            ban_mask = '*!%%(target_identm)s@%s*' % gateway.group(1)
-                        if not self.do_akick:
-                            self.actions.insert(self.actions.index(
-                                'mode %(channel)s +%(banmode)s *!*@%(target_host)s%(forward_to)s'),
-                                'mode %%(channel)s +%%(banmode)s %s%%(forward_to)s' % ban_mask)
-                            self.actions.remove('mode %(channel)s +%(banmode)s *!*@%(target_host)s%(forward_to)s')
-                        else:
-                            self.actions.insert(self.actions.index(
-                                'ChanServ akick %(channel)s add *!*@%(target_host)s %(akick_opts)s %(reason)s'),
-                                'ChanServ akick %%(channel)s add %s %%(akick_opts)s %%(reason)s' % ban_mask)
-                            self.actions.remove('ChanServ akick %(channel)s add *!*@%(target_host)s %(akick_opts)s %(reason)s')
-                    # Don't try IP address ban if none found
-                    if 'i' in self.bans and not self.target_ipaddrm:
-                        if not self.do_akick:
-                            self.actions.remove('mode %(channel)s +%(banmode)s *!*@%(target_ipaddrm)s%(forward_to)s')
-                        else:
-                            self.actions.remove('ChanServ akick %(channel)s add *!*@%(target_ipaddrm)s %(akick_opts)s %(reason)s')
-                        xchat.emit_print('Server Error', "Cannot do an IP address ban for '%s', none found." % self.target_nick)
-                    # Don't try account ban if not identified
-                    if 'a' in self.bans and not self.target_account:
-                        self.actions.remove('mode %(channel)s +%(banmode)s $a:%(target_account)s%(forward_to)s')
-                        xchat.emit_print('Server Error', "Cannot do an account ban for '%s', not identified." % self.target_nick)
-
-                run_pending()
+    def steps(self):
+        """Gather the needed information, get op and run"""
+        if self.needs_resolved and not self.resolved:
+            user = yield whois(self.context, self.target_nickm)
+            if not user:
+                xchat.emit_print('Server Error', "Cannot find '%s'" % self.target_nick)
+                self.done(result='not found')
+                return
+            self.resolve_nick(user)
+
+        if self.by_account and not self.planned:
+            if not accounts_known(self.network, self.channel):
+                yield wholist(self.context, self.channel)
+            self.kick_account()
+
+        if self.do_ban and not self.planned:
+            self.actions[:0] = self.ban_ops()
+            self.planned = True
+
+        if self.do_unban or self.do_bans or self.do_compact or self.sync or (self.do_ban and self.check_bans and self.actions):
+            yield banlist(self.context, self.channel)
+            if self.do_akick and self.channel not in can_do_akick[self.network]:
+                # ChanServ refused the AKICK list, so ban with +b
+                self.do_akick = False
+                self.actions = [Op('mode', '+', self.banmode, op.mask, self.forward_to) if op.verb == 'akick' else op
+                                for op in self.actions]
+            # Lists that $j: bans refer to, all at once; those that cannot be
+            # fetched stay unknown and match nothing
+            if (self.do_unban or self.do_bans) and self.target:
+                seen, entries = set([self.channel]), bans[self.channel] + quiets[self.channel]
+                while entries:
+                    others = []
+                    for entry in entries:
+                        other = joined_channel(entry.mask)
+                        if other and other not in seen:
+                            seen.add(other)
+                            others.append(other)
+                    yield gather([banlist(self.context, other) for other in others], self)
+                    entries = [entry for other in others if other in ban_stamps for entry in bans[other]]
+            self.parse_bans()
+
+        elif self.do_matches or self.do_clones:
+            if not roster_known(self.channel):
+                yield wholist(self.context, self.channel)
+            self.parse_whos()
+
+        # Got anything to do?
+        if not self.actions:
+            self.done()
+            return
+
+        # Am I opped?
+        if self.needs_op:
+            if (yield op(self.context, self.channel)):
+                self.deop = True
+                self.me_curr = self.context.get_info('nick')
+            self.am_op = True
         else:
-            resolving_users.append(self.target_nickm)
-            self.context.command('whois %s' % self.target_nickm)
-
-    def fetch_bans(self):
-        """Read bans for a channel"""
-        bans[self.channel] = []
-        quiets[self.channel] = []
-        akicks[self.channel] = []
-        if self.network in quiet_networks:
-            self.context.command('mode %s +qb' % self.channel)
+            self.am_op = is_opped(self.context, self.channel)
+
+        if self.do_ban and self.check_bans and not self.do_akick:
+            # Exceptions and invites sharing MAXLIST are only listed to ops
+            modes, limit = list_limit(self.network, self.banmode)
+            modes = ''.join(mode for mode in modes if mode in 'eI')
+            counts = None
+            if limit and modes and any(op.verb == 'mode' and op.sign == '+' and op.letter == self.banmode
+                                       for op in self.actions):
+                try:
+                    counts = yield listcounts(self.context, self.channel, modes)
+                except Timeout:
+                    pass
+            self.make_room(counts)
+
+        if self.room_actions:
+            self.perform(self.room_actions)
+
+        if self.paced:
+            # Hold op until our share of the queue is out
+            self.perform(self.actions[:])
+            yield drained()
+            self.done()
         else:
-            self.context.command('mode %s +b' % self.channel)
-        if self.channel in can_do_akick:
-            self.context.command('ChanServ akick %s list' % self.channel)
+            self.run()
+
+    def fail(self, reason):
+        """Give up on this action"""
+        xchat.emit_print('Server Error', 'Operation on %s failed: %s.' % (self.channel, reason))
+        self.done(result=reason)
+
+    def resolve_nick(self, user):
+        """Take nick, ident and host from a Whois reply"""
+        self.target_ident = user.ident
+        self.target_identm = get_identm(self.target_ident)
+        self.target_host = user.host
+        self.target_mask = '%s!%s@%s' % (self.target_nick, self.target_ident, self.target_host)
+        self.target_maskm = '%s!%s@%s' % (self.target_nick, self.target_identm, self.target_host)
+        self.target_account = user.account
+        self.target_name = user.name
+        self.target_name_bannable = self.target_name.replace(r' ', '?')
+        self.target_ipaddr, self.target_ipaddrm = get_ipaddr(self.target_host)
+        self.resolved = True
+
+        xchat.emit_print('Server Text', '\x02%s\x02 (a: %s, r: %s)' %
+            (self.target_mask, self.target_account, self.target_name))
+
+    def kick_account(self):
+        """Kick the members logged in as the target account"""
+        nicks = account_members.get(self.channel, {}).get(irc_lower(self.target_account), {})
+        nicks = sorted(nick for key, nick in nicks.items() if key != irc_lower(self.me_curr))
+        xchat.emit_print('Server Text', '\x02%s\x02: %s' % (self.target_account, ', '.join(nicks) or 'nobody logged in'))
+        if self.command in kick_commands:
+            verb = 'remove' if self.network in remove_networks else 'kick'
+            self.actions += [Op(verb, args='%s %s' % (nick, self.reason)) for nick in nicks]
+
+    def ban_ops(self):
+        """The bans or AKICKs for the target"""
+        masks, extbans = [], []
+        if 'f' in self.bans:
+            masks.append(self.target_maskm)
+        if 'n' in self.bans:
+            masks.append('%s!*@*' % self.target_nick)
+        if 'u' in self.bans:
+            masks.append('*!%s@*' % self.target_identm)
+        if 'h' in self.bans:
+            # For gateway users, use different defaults
+            if self.bans == 'h' and re.match('^(gateway/(shell|web)|conference|nat)/', self.target_host):
+                if re.match(r'^gateway/web/freenode/', self.target_host):
+                    masks.append('*!*@%s' % self.target_ipaddr)
+                else:
+                    gateway = re.match(r'^((gateway/shell|conference|nat)/.+/|gateway/web/)', self.target_host)
+                    masks.append('*!%s@%s*' % (self.target_identm, gateway.group(1)))
+            else:
+                masks.append('*!*@%s' % self.target_host)
+        if 'i' in self.bans:
+            # Don't try IP address ban if none found
+            if self.target_ipaddrm:
+                masks.append('*!*@%s' % self.target_ipaddrm)
+            else:
+                xchat.emit_print('Server Error', "Cannot do an IP address ban for '%s', none found." % self.target_nick)
+        if 'a' in self.bans:
+            # Don't try account ban if not identified
+            if self.target_account:
+                extbans.append('$a:%s' % self.target_account)
+            else:
+                xchat.emit_print('Server Error', "Cannot do an account ban for '%s', not identified." % self.target_nick)
+        if 'r' in self.bans:
+            extbans.append('$r:%s' % self.target_name_bannable)
+        if 'x' in self.bans:
+            extbans.append('$x:%s!%s@%s#%s' % (self.target_nick, self.target_identm, self.target_host, self.target_name_bannable))
+
+        if not self.do_akick:
+            return [Op('mode', '+', self.banmode, self.quiet_prefix + mask, self.forward_to) for mask in masks + extbans]
+        return ([Op('akick', '+', mask=mask, args=self.akick_opts) for mask in masks] +
+                [Op('mode', '+', self.banmode, self.quiet_prefix + mask) for mask in extbans])
 
     def parse_bans(self):
         """Check bans and schedule unbans"""
         if self.do_ban and self.check_bans:
-            kwargs = dict(list(self.__dict__.items()))
-
-            for action in self.actions[:]:
-                action_res = action % kwargs
-                action_split = action_res.split()
-
-                if action_split[0] == 'mode':
-                    if action_split[2] == '+q':
-                        for quiet in quiets[self.channel]:
-                            if quiet[0][1:].rsplit('$', 1)[0] == action_split[3][1:].rsplit('$', 1)[0]:
-                                self.actions.remove(action)
-                                xchat.emit_print('Server Error', '\x02%s\x02 is already on quiet list.' % quiet[0])
-
-                    elif action_split[2] == '+b':
-                        for ban in bans[self.channel]:
-                            if ban[0][1:].rsplit('$', 1)[0] == action_split[3][1:].rsplit('$', 1)[0]:
-                                self.actions.remove(action)
-                                xchat.emit_print('Server Error', '\x02%s\x02 is already on ban list.' % ban[0])
-
-                elif action.startswith('ChanServ akick'):
-                    for akick in akicks[self.channel]:
-                        if akick[0] == action_split[4]:
-                            self.actions.remove(action)
-                            xchat.emit_print('Server Error', '\x02%s\x02 is already on AKICK list.' % akick[0])
-
-        elif self.do_unban or self.do_bans:
-            bans_fnd = False
-
-            if not self.target:
-                xchat.emit_print('Server Text', 'Channel: \x02%s\x02' % self.channel)
+            lists = {('mode', 'q'): (quiet_keys, 'quiet'), ('mode', 'b'): (ban_keys, 'ban'), ('akick', ''): (akick_keys, 'AKICK')}
+            actions = []
+            mapping = casemapping(self.network)
+
+            for op in self.actions:
+                found = None
+                if op.sign == '+' and (op.verb, op.letter) in lists:
+                    keys, name = lists[op.verb, op.letter]
+                    found = keys[self.channel].get(mask_key(op.mask, mapping))
+
+                if found:
+                    xchat.emit_print('Server Error', '\x02%s\x02 is already on %s list.' % (found, name))
+                else:
+                    actions.append(op)
+            self.actions = actions
 
+        elif self.do_unban:
             for quiet in quiets[self.channel]:
-                if not self.target or self.match(quiet[0], self):
-                    bans_fnd = True
-                    if self.do_bans:
-                        xchat.emit_print('Server Text', 'Quiet: \x02%s\x02 [setter: %s, date: %s]' % (quiet[0], quiet[1], quiet[2][4:]))
-                    else:
-                        self.actions.append('mode %s -q %s' % (self.channel, quiet[0]))
-
+                if self.match(quiet.mask, self):
+                    self.actions.append(Op('mode', '-', 'q', quiet.mask))
             for ban in bans[self.channel]:
-                if not self.target or self.match(ban[0], self):
-                    bans_fnd = True
-                    if self.do_bans:
-                        xchat.emit_print('Server Text', 'Ban: \x02%s\x02 [setter: %s, date: %s]' % (ban[0], ban[1], ban[2][4:]))
-                    else:
-                        self.actions.append('mode %s -b %s' % (self.channel, ban[0]))
-
+                if self.match(ban.mask, self):
+                    self.actions.append(Op('mode', '-', 'b', ban.mask))
             for akick in akicks[self.channel]:
-                if not self.target or self.match(akick[0], self):
-                    bans_fnd = True
-                    if self.do_bans:
-                        xchat.emit_print('Server Text', 'AKICK: %s' % akick[1])
-                    else:
-                        self.actions.append('ChanServ akick %s del %s' % (self.channel, akick[0]))
-
-            if not bans_fnd:
-                if not self.target:
-                    xchat.emit_print('Server Text', '\x02No bans for this channel.\x02')
+                if self.match(akick.mask, self):
+                    self.actions.append(Op('akick', '-', mask=akick.mask))
+
+            if not self.actions:
+                xchat.emit_print('Server Text', '\x02No matching bans for this user.\x02')
+
+        elif self.do_bans:
+            self.list_bans()
+
+        elif self.do_compact:
+            counts = []
+            for mode, name, entries in (('q', 'quiets', quiets[self.channel]), ('b', 'bans', bans[self.channel])):
+                redundant = redundant_masks([entry.mask for entry in entries], casemapping(self.network))
+                for mask, cover in redundant:
+                    xchat.emit_print('Server Text', 'Redundant: \x02%s\x02 (covered by \x02%s\x02)' % (mask, cover))
+                if not self.compact_check:
+                    self.actions += [Op('mode', '-', mode, mask) for mask, cover in redundant]
+                counts.append('%d of %d %s' % (len(redundant), len(entries), name))
+            xchat.emit_print('Server Text', '\x02%s\x02: %s redundant.' % (self.channel, ' and '.join(counts)))
+
+        elif self.sync:
+            removals, additions, akick_ops, counts = [], [], [], []
+            mapping = casemapping(self.network)
+            for mode, name, entries in (('b', 'bans', bans[self.channel]), ('q', 'quiets', quiets[self.channel]),
+                                        ('akick', 'AKICKs', akicks[self.channel])):
+                if mode not in self.sync:
+                    continue
+                wanted = self.sync[mode]
+                current = dict((irc_lower(entry.mask, mapping), entry.mask) for entry in entries)
+                remove = [current[key] for key in current if key not in wanted]
+                add = [wanted[key] for key in wanted if key not in current]
+                if mode == 'akick':
+                    akick_ops += [Op('akick', '-', mask=mask) for mask in remove]
+                    akick_ops += [Op('akick', '+', mask=mask, args=reason) for mask, reason in add]
                 else:
-                    xchat.emit_print('Server Text', '\x02No matching bans for this user.\x02')
-
-        self.bans_parsed = True
-        run_pending()
-
-    def fetch_whos(self):
-        """Read whos for a channel"""
-        whos[self.channel] = []
-        self.context.command('who %s %%cnuhar' % self.channel)
+                    removals += [Op('mode', '-', mode, mask) for mask in remove]
+                    additions += [Op('mode', '+', mode, mask) for mask in add]
+                counts.append('-%d/+%d %s' % (len(remove), len(add), name))
+            # Removals first, to make room on full lists
+            self.actions = removals + additions + akick_ops
+            xchat.emit_print('Server Text', '\x02%s\x02: sync %s.' % (self.channel, ', '.join(counts)))
+
+    def list_bans(self):
+        """Filter and sort the cached lists, then print or write them out"""
+        listing = self.listing or {}
+        lists = (('q', quiets[self.channel]), ('b', bans[self.channel]), ('akick', akicks[self.channel]))
+        setter = listing.get('setter', '').lower()
+        text = listing.get('match', '').lower()
+        older, newer = listing.get('older'), listing.get('newer')
+        now = time.time()
+
+        entries = []
+        for kind, entries_of in lists:
+            if kind not in listing.get('type', (kind,)):
+                continue
+            for entry in entries_of:
+                if self.target and not self.match(entry.mask, self):
+                    continue
+                # AKICKs only know their setter and age from the entry text
+                if setter and setter not in (entry.setter or entry.info or '').lower():
+                    continue
+                if text and text not in entry.mask.lower() and text not in (entry.info or '').lower():
+                    continue
+                if (older is not None or newer is not None) and (not entry.stamp or
+                        (older is not None and now - entry.stamp < older) or
+                        (newer is not None and now - entry.stamp > newer)):
+                    continue
+                entries.append((kind, entry))
+
+        order = listing.get('sort')
+        if order:
+            keys = {'date': lambda item: item[1].stamp,
+                    'mask': lambda item: irc_lower(item[1].mask),
+                    'setter': lambda item: (item[1].setter or '').lower()}
+            entries.sort(key=keys[order.lstrip('-')], reverse=order.startswith('-'))
+
+        lines = (format_entry(kind, entry) for kind, entry in entries)
+        if 'file' in listing:
+            write_lines(listing['file'], lines, len(entries))
+            return
+
+        if not self.target:
+            xchat.emit_print('Server Text', 'Channel: \x02%s\x02' % self.channel)
+        if not entries:
+            if not self.target and not listing:
+                xchat.emit_print('Server Text', '\x02No bans for this channel.\x02')
+            else:
+                xchat.emit_print('Server Text', '\x02No matching bans for this user.\x02' if self.target
+                                 else '\x02No matching bans.\x02')
+            return
+        stream(self.context, lines)
+
+    def make_room(self, counts=None):
+        """Free up list space for our new bans, according to full_list_policy;
+        counts has the entries of the other lists sharing the limit"""
+        modes, limit = list_limit(self.network, self.banmode)
+        if not limit:
+            return
+        lists = {'b': bans, 'q': quiets}
+        new = len([op for op in self.actions if op.verb == 'mode' and op.sign == '+' and op.letter == self.banmode])
+        counts = dict(counts or {}, **dict((m, len(lists[m][self.channel])) for m in lists))
+        used = sum(counts.get(m, 0) for m in modes)
+        overflow = used + new - limit
+        uncounted = ''.join(m for m in modes if m not in counts)
+        if new and uncounted and -list_margin < overflow <= 0:
+            xchat.emit_print('Server Error', 'The +%s list of %s may be full (%d of %d, not counting +%s), the new ban may fail.' %
+                (self.banmode, self.channel, used, limit, uncounted))
+        if not new or overflow <= 0:
+            return
+
+        entries = sorted(lists[self.banmode][self.channel], key=lambda entry: entry.stamp)
+        if full_list_policy == 'warn':
+            xchat.emit_print('Server Error', 'The +%s list of %s is full (%d of %d), the new ban will fail.' %
+                (self.banmode, self.channel, used, limit))
+            return
+        if full_list_policy == 'akick' and self.banmode == 'b' and self.channel in can_do_akick[self.network]:
+            # AKICKs have no forwards or extbans
+            entries = [e for e in entries if re.match(r'^[^$ ]+![^$ ]+@[^$ ]+$', e.mask)]
+            moved = entries[:overflow]
+            for entry in moved:
+                self.room_actions.append(Op('akick', '+', mask=entry.mask,
+                    args='Moved from ban list (set by %s)' % entry.setter.split('!')[0]))
+                xchat.emit_print('Server Text', 'Moving \x02%s\x02 to the AKICK list.' % entry.mask)
+            if len(moved) < overflow:
+                xchat.emit_print('Server Error', 'Only %d of %d bans on %s can be moved to the AKICK list.' %
+                    (len(moved), overflow, self.channel))
+        else:
+            moved = entries[:overflow]
+            for entry in moved:
+                xchat.emit_print('Server Text', 'Expiring \x02%s\x02 [setter: %s, date: %s] to make room.' %
+                    (entry.mask, entry.setter, entry.date))
+        self.room_actions += [Op('mode', '-', self.banmode, entry.mask) for entry in moved]
 
     def parse_whos(self):
         """Check whos for matches"""
         if self.do_matches:
             matches, nicks = [], ''
 
-            for who in whos[self.channel]:
+            for who in whos[self.channel].values():
                 if self.match(self.target_mask, who):
                     matches.append(who.target_nick)
 
@@ -634,56 +1063,74 @@ class Action(object):
             else:
                 xchat.emit_print('Server Text', '\x02No matches for this mask.\x02')
 
-        self.whos_parsed = True
-        run_pending()
-
-    def get_prefix(self):
-        if self.channel == self.context.get_info('channel'):
-            self.me_curr = self.context.get_info('nick')
-            for user in self.context.get_list('users'):
-                if user.nick == self.me_curr:
-                    return user.prefix
-            return ''
-        return ''
+        elif self.do_clones:
+            clusters = clone_clusters(whos[self.channel].values(), self.clone_min)
+            me = irc_lower(self.me_curr)
+            for mask, nicks in clusters:
+                xchat.emit_print('Server Text', 'Clones: \x02%s\x02 (%d): %s' % (mask, len(nicks),
+                    ', '.join(nicks[:11]) + (', ...' if len(nicks) > 12 else ', ' + nicks[11] if len(nicks) == 12 else '')))
+                if not self.clone_ban:
+                    continue
+                if me in [irc_lower(nick) for nick in nicks]:
+                    xchat.emit_print('Server Error', 'Not banning \x02%s\x02, it matches yourself.' % mask)
+                else:
+                    self.actions.append(Op('mode', '+', 'b', mask))
+            xchat.emit_print('Server Text', '\x02%s\x02: %d group%s of %d or more users.' %
+                (self.channel, len(clusters), '' if len(clusters) == 1 else 's', self.clone_min))
 
     def run(self):
         """Perform all registered actions"""
-        kwargs = dict(list(self.__dict__.items()))
-
-        for action in self.actions[:]:
-            if action.startswith('ChanServ op') and self.am_op:
-                action = 'mode %(channel)s +o %(target_nick)s'
-            elif action.startswith('ChanServ deop') and self.am_op:
-                action = 'mode %(channel)s -o %(target_nick)s'
-            elif action.startswith('ChanServ voice') and self.am_op:
-                action = 'mode %(channel)s +v %(target_nick)s'
-            elif action.startswith('ChanServ devoice') and self.am_op:
-                action = 'mode %(channel)s -v %(target_nick)s'
-
-            action_res = action % kwargs
-            self.context.command(action_res)
-            if action.startswith('ChanServ akick'):
-                self.actions.remove(action)
-
+        self.perform(self.actions[:])
         self.done()
 
-    def done(self):
+    def perform(self, actions):
+        """Send some of the registered actions, through the queue if paced"""
+        ops = []
+        for op in actions:
+            if op.verb in op_modes and self.am_op:
+                sign, letter = op_modes[op.verb]
+                op = Op('mode', sign, letter, op.args)
+            elif op.verb == 'akick':
+                if op in self.actions:
+                    self.actions.remove(op)
+                if op.sign == '+':
+                    akicks_sent[self.channel, mask_key(op.mask)] = op.args
+            ops.append(op)
+
+        for line in render_ops(self.channel, ops, modes_limit(self.network)):
+            if self.paced:
+                outbox.append((self.context, line, self.command))
+            else:
+                send(self.context, line, self.command)
+        if self.paced:
+            flush_outbox()
+
+    def done(self, result='ok'):
         """Finalization and cleanup"""
         if self in pending:
             pending.remove(self)
+        record_result(self, result)
 
-        # Deop?
+        # Deop? Leave that to the next action still needing op here
         if self.deop:
-            self.context.command('mode %s -o %s' % (self.channel, self.me_curr))
+            for p in pending:
+                if p.channel == self.channel and p.needs_op and p.actions:
+                    p.deop = True
+                    p.me_curr = self.me_curr
+                    break
+            else:
+                send(self.context, 'mode %s -o %s' % (self.channel, self.me_curr), self.command)
             self.deop = False
 
         # Schedule removal?
-        if self.do_ban and self.timer and self.actions:
-            self.actions = [a.replace('+%(banmode)s', '-%(banmode)s') for a in self.actions]
-            xchat.hook_timer(self.timer * 60000, lambda act: act.schedule(update_stamp=True) and False, self)
+        if self.do_ban and self.timer:
+            self.actions = [op.inverted() for op in self.actions if op.verb == 'mode' and op.sign == '+']
+            if self.actions:
+                self.check_bans = False
+                xchat.hook_timer(self.timer * 60000, lambda act: act.schedule(update_stamp=True) and False, self)
             self.timer = 0
 
-    def match(self, ban, action):
+    def match(self, ban, action, seen=None):
         """Does a ban match this action"""
         if re.match(r'^[^$][^ ]*![^ ]+@[^ ]+$', ban):
             result = re.compile('^' + re.escape(ban.rsplit('$', 1)[0]).replace(r'\*', '.*').replace(r'\?', '.').replace(r'!\~', '!\~?') + '$').match('%s!%s@%s' %
@@ -702,11 +1149,305 @@ class Action(object):
             return re.compile('^' + re.escape(ban[3:].rsplit('$', 1)[0]).replace(r'\*', '.*').replace(r'\?', '.').replace(r'!\~', '!\~?') + '$').match('%s!%s@%s#%s' %
                 (action.target_nick, action.target_ident, action.target_host, action.target_name))
         elif re.match(r'^\$j:[^ ]+$', ban):
-            return 1
+            # Banned in the other channel, as far as its cached bans tell
+            other = joined_channel(ban)
+            seen = seen or set([self.channel])
+            if other in seen or other not in ban_stamps:
+                return None
+            seen.add(other)
+            for entry in bans[other]:
+                if self.match(entry.mask, action, seen):
+                    return 1
         elif re.match(r'^\$~a$', ban):
             if not action.target_account:
                 return 1
 
+def irc_lower(text, mapping='rfc1459'):
+    """Case fold text by a CASEMAPPING"""
+    text = text.lower()
+    if mapping == 'ascii':
+        return text
+    text = text.replace('[', '{').replace(']', '}').replace('\\', '|')
+    if mapping == 'strict-rfc1459':
+        return text
+    return text.replace('~', '^')
+
+def mask_key(mask, mapping='rfc1459'):
+    """A mask without its forward, case folded"""
+    return irc_lower(split_forward(mask)[0], mapping)
+
+def split_forward(mask):
+    """Split a mask into the mask proper and its $#channel forward"""
+    i = mask.rfind('$', 1)
+    if i > 0:
+        return mask[:i], mask[i:]
+    return mask, ''
+
+def parse_duration(text):
+    """Seconds in an age like 90, 30m, 12h, 7d or 2w, or None"""
+    match = re.match(r'^([0-9]+)([smhdw]?)$', text)
+    if match:
+        return int(match.group(1)) * {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}[match.group(2)]
+
+def format_entry(kind, entry):
+    """The /cs bans line for a list entry"""
+    if kind == 'akick':
+        return 'AKICK: %s' % entry.info
+    return '%s: \x02%s\x02 [setter: %s, date: %s]' % ('Quiet' if kind == 'q' else 'Ban', entry.mask, entry.setter, entry.date)
+
+def stream(context, lines):
+    """Print lines list_chunk at a time, one chunk per timer tick"""
+    lines = iter(lines)
+    def tick(userdata=None):
+        chunk = list(itertools.islice(lines, list_chunk))
+        for line in chunk:
+            context.emit_print('Server Text', line)
+        return len(chunk) == list_chunk
+    if tick():
+        xchat.hook_timer(list_interval, tick)
+
+def write_lines(name, lines, count):
+    """Write lines to a file relative to the XChat directory"""
+    path = os.path.join(xchat.get_info('xchatdir'), os.path.expanduser(name))
+    try:
+        with open(path, 'w') as f:
+            for line in lines:
+                f.write(line.replace('\x02', '') + '\n')
+    except (IOError, OSError) as e:
+        xchat.emit_print('Server Error', 'Cannot write %s: %s' % (path, e))
+        return
+    xchat.emit_print('Server Text', 'Wrote %d entries to %s.' % (count, path))
+
+def network_name(server):
+    """The network a server belongs to, as used in the *_networks lists"""
+    labels = server.split('.')
+    return labels[-2] if len(labels) > 1 else server
+
+def server_token(network, name, default=None):
+    """An ISUPPORT token of a network, or default if not known"""
+    return capabilities.get(network, {}).get('isupport', {}).get(name, default)
+
+def casemapping(network):
+    return server_token(network, 'CASEMAPPING', 'rfc1459')
+
+def modes_limit(network):
+    """Mode changes per MODE line on a network"""
+    modes = server_token(network, 'MODES', '')
+    return int(modes) if modes.isdigit() and int(modes) else modes_per_line
+
+def quiet_mode(network):
+    """The list mode and mask prefix for quiets on a network: ('q', '') where
+    +q is a list mode, ('b', '~q:') where quiets are extbans, else (None, '')"""
+    if not capabilities.get(network, {}).get('isupport'):
+        return ('q', '') if network in quiet_networks else (None, '')
+    if 'q' in server_token(network, 'CHANMODES', '').split(',')[0]:
+        return ('q', '')
+    prefix, _, types = server_token(network, 'EXTBAN', '').partition(',')
+    if 'q' in types:
+        return ('b', prefix + 'q:')
+    return (None, '')
+
+def has_whox(network):
+    """Whether WHO takes WHOX fields, assumed if the tokens are not known"""
+    return not capabilities.get(network, {}).get('isupport') or server_token(network, 'WHOX') is not None
+
+def joined_channel(mask):
+    """The channel a $j: ban refers to, or None"""
+    if mask.startswith('$j:'):
+        return split_forward(mask[3:])[0]
+
+def parse_modes(network, word):
+    """(sign, letter, argument) for each change of a MODE line"""
+    groups = server_token(network, 'CHANMODES', 'eIbq,k,flj,').split(',') + ['', '', '']
+    prefix = server_token(network, 'PREFIX', '(ov)@+')
+    with_arg = groups[0] + groups[1] + prefix[1:prefix.find(')')]
+    args = iter(arg.lstrip(':') for arg in word[4:])
+    sign = '+'
+    for letter in word[3].lstrip(':'):
+        if letter in '+-':
+            sign = letter
+        elif letter in with_arg or (sign == '+' and letter in groups[2]):
+            yield sign, letter, next(args, None)
+        else:
+            yield sign, letter, None
+
+def list_limit(network, mode):
+    """The MAXLIST limit for mode, and the modes sharing it"""
+    for item in server_token(network, 'MAXLIST', '').split(','):
+        modes, _, limit = item.partition(':')
+        if mode in modes and limit.isdigit():
+            return modes, int(limit)
+    return '', None
+
+class Op(object):
+    """A command or mode change of an action, rendered when sent"""
+    __slots__ = ('verb', 'sign', 'letter', 'mask', 'forward', 'args')
+
+    def __init__(self, verb, sign='', letter='', mask='', forward='', args=''):
+        self.verb = verb
+        self.sign = sign
+        self.letter = letter
+        self.mask = mask
+        self.forward = forward
+        self.args = args or ''
+
+    def render(self, channel):
+        if self.verb == 'mode' and self.letter:
+            return 'mode %s %s%s %s%s' % (channel, self.sign, self.letter, self.mask, self.forward)
+        elif self.verb == 'akick':
+            if self.sign == '-':
+                return 'ChanServ akick %s del %s' % (channel, self.mask)
+            return ('ChanServ akick %s add %s %s' % (channel, self.mask, self.args)).rstrip()
+        elif self.verb == 'invite':
+            return 'invite %s %s' % (self.args, channel)
+        return ('%s %s %s' % (self.verb, channel, self.args)).rstrip()
+
+    def inverted(self):
+        return Op(self.verb, '-' if self.sign == '+' else '+', self.letter, self.mask, self.forward, self.args)
+
+# ChanServ commands we can do ourselves when opped
+op_modes = {'ChanServ op': ('+', 'o'), 'ChanServ deop': ('-', 'o'),
+            'ChanServ voice': ('+', 'v'), 'ChanServ devoice': ('-', 'v')}
+
+def render_ops(channel, ops, per_line=None):
+    """Lines for ops, with runs of mode changes packed per_line to a line"""
+    lines, changes = [], []
+    for op in ops + [None]:
+        if op and op.verb == 'mode' and op.letter:
+            changes.append((op.sign + op.letter, op.mask + op.forward))
+            continue
+        lines += mode_lines(channel, changes, per_line)
+        changes = []
+        if op:
+            lines.append(op.render(channel))
+    return lines
+
+def mode_lines(channel, changes, per_line=None):
+    """Pack (+b, mask) style changes into MODE lines of per_line changes
+    (modes_per_line by default) and at most max_mode_line characters each"""
+    per_line = per_line or modes_per_line
+    lines, chunk = [], []
+    for change in changes:
+        if chunk and (len(chunk) == per_line or len(mode_line(channel, chunk + [change])) > max_mode_line):
+            lines.append(mode_line(channel, chunk))
+            chunk = []
+        chunk.append(change)
+    if chunk:
+        lines.append(mode_line(channel, chunk))
+    return lines
+
+def mode_line(channel, chunk):
+    modes, sign = '', None
+    for change, mask in chunk:
+        if change[0] != sign:
+            sign = change[0]
+            modes += sign
+        modes += change[1:]
+    return 'mode %s %s %s' % (channel, modes, ' '.join(mask for change, mask in chunk))
+
+def read_sync_file(name, mapping='rfc1459'):
+    """Read the wanted lists of a sync file, keyed by list and folded mask"""
+    path = os.path.join(xchat.get_info('xchatdir'), os.path.expanduser(name))
+    wanted = {}
+    try:
+        with open(path) as f:
+            for num, line in enumerate(f, 1):
+                fields = [] if line.lstrip().startswith('#') else line.split(None, 2)
+                if not fields:
+                    continue
+                mode = fields[0].lower()
+                if mode not in ('b', 'q', 'akick'):
+                    xchat.emit_print('Server Error', '%s:%d: unknown list %s' % (name, num, fields[0]))
+                    return None
+                entries = wanted.setdefault(mode, {})
+                if len(fields) > 1:
+                    mask = fields[1]
+                    entries[irc_lower(mask, mapping)] = (mask, fields[2].strip() if len(fields) > 2 else akick_message) if mode == 'akick' else mask
+    except (IOError, OSError) as e:
+        xchat.emit_print('Server Error', 'Cannot read %s: %s' % (path, e))
+        return None
+    return wanted
+
+def mask_regex(mask):
+    """A regex matching the masks that mask covers: its wildcards may only
+    be matched by wildcards at least as broad"""
+    return re.compile('^' + ''.join('.*' if c == '*' else '[^*]' if c == '?' else re.escape(c) for c in mask) + '$')
+
+def redundant_masks(masks, mapping='rfc1459'):
+    """Masks covered by another mask of the list, as (mask, cover) pairs
+
+    Only masks of the same type and forward can cover each other. Masks with
+    a literal host are only compared with masks on that same host; of equal
+    masks, the first one is kept."""
+    entries, groups, hosts = [], collections.defaultdict(list), collections.defaultdict(list)
+    for i, mask in enumerate(masks):
+        base, forward = split_forward(mask)
+        base = irc_lower(base, mapping)
+        group = base[:3] + forward if base.startswith('$') else forward
+        host = base.rsplit('@', 1)[1] if not base.startswith('$') and '@' in base else None
+        entry = (i, base, group, host)
+        entries.append(entry)
+        groups[group].append(entry)
+        if host is not None and '*' not in host and '?' not in host:
+            hosts[group, host].append(entry)
+
+    regexes = {}
+    def covers(broad, narrow):
+        if broad not in regexes:
+            regexes[broad] = mask_regex(broad)
+        return regexes[broad].match(narrow)
+
+    cover = {}
+    for i, base, group, host in entries:
+        if host is not None and (group, host) in hosts:
+            candidates = hosts[group, host]
+        else:
+            candidates = groups[group]
+        for j, other, _, _ in candidates:
+            if j == i or j in cover or not covers(base, other):
+                continue
+            # Of equal masks, keep the first one
+            if j < i and covers(other, base):
+                continue
+            cover[j] = i
+
+    result = []
+    for j in sorted(cover):
+        i = cover[j]
+        while i in cover:
+            i = cover[i]
+        result.append((masks[j], masks[i]))
+    return result
+
+def clone_clusters(roster, minimum):
+    """Groups of at least minimum users sharing a host, IP address, /24 or
+    /64 network, or ident on a gateway, as (mask, nicks) pairs
+
+    Narrower groups come first, larger ones first within a kind; a group of
+    the same users as a narrower one is left out."""
+    kinds = ({}, {}, {}, {})
+    for who in roster:
+        host = who.target_host.lower()
+        kinds[0].setdefault('*!*@' + host, []).append(who.target_nick)
+        ipaddr, ipaddrm = get_ipaddr(host)
+        if ipaddr:
+            if ipaddr != host:
+                kinds[1].setdefault('*!*@' + ipaddr, []).append(who.target_nick)
+            network = ipaddrm if ':' in ipaddr else ipaddr.rsplit('.', 1)[0] + '.*'
+            kinds[2].setdefault('*!*@' + network, []).append(who.target_nick)
+        gateway = re.match(r'^((gateway/shell|conference|nat)/.+/|gateway/web/)', host)
+        if gateway:
+            kinds[3].setdefault('*!%s@%s*' % (get_identm(who.target_ident), gateway.group(1)), []).append(who.target_nick)
+
+    seen, result = set(), []
+    for groups in kinds:
+        for mask, nicks in sorted(groups.items(), key=lambda item: (-len(item[1]), item[0])):
+            members = frozenset(nicks)
+            if len(nicks) >= minimum and members not in seen:
+                seen.add(members)
+                result.append((mask, sorted(nicks, key=str.lower)))
+    return result
+
 def get_identm(target_ident):
     if target_ident.startswith('~'):
         return target_ident.replace('~', '*', 1)
@@ -737,90 +1478,604 @@ def shorten_ipv6(ipaddr):
     ipaddr = re.sub(r'(:[^:]{1,4}){4}$', ':*', ipaddr, count=1)
     return re.sub(r'(^|:)(0(:|$)){2,}', '::', ipaddr, count=1)
 
-def run_pending(me_curr=None, just_opped=None):
-    """Check all actions and run them if all information is there"""
-    can_run = False
-
-    for p in pending:
-        # Find needed information
-        if p.needs_resolved and not p.resolved:
-            can_run = False
-            p.resolve_nick()
-        else:
-            can_run = True
-
-        if can_run and (p.do_unban or p.do_bans or (p.do_ban and p.check_bans and p.actions)):
-            if p.channel in collecting_bans:
-                can_run = False
-                p.fetch_bans()
-            elif not p.bans_parsed:
-                can_run = False
-                p.parse_bans()
-            else:
-                can_run = True
-
-        elif can_run and p.do_matches:
-            if p.channel in collecting_whos:
-                can_run = False
-                p.fetch_whos()
-            elif not p.whos_parsed:
-                can_run = False
-                p.parse_whos()
+# Cooperative scheduler
+#
+# Actions are written as generators (or async coroutines) that yield or await
+# Wait objects from whois(), banlist(), wholist() and op(). Server hooks wake
+# the tasks waiting on a key, and the sweeper retries or fails waits that
+# are overdue. Example:
+#
+#   def steps():
+#       user = yield whois(context, 'nick')
+#       bans, quiets, akicks = yield banlist(context, '#channel')
+#       yield op(context, '#channel')
+#
+# and likewise `user = await whois(context, 'nick')` inside an async def.
+tasks = []
+waiting = {}
+# Paced outbound lines: (context, line, command), or (None, key, cost) to
+# wake key once the lines before it are sent and cost more lines may be
+# sent; cost is 0 for drained() and the lines a warm-up fetch sends
+outbox = collections.deque()
+outbox_ids = itertools.count()
+outbox_timer = None
+outbox_tokens = 0
+outbox_stamp = 0
+# Channels whose caches are being warmed up
+warm_ups = set()
+stage_names = {'resolve': 'nick resolution', 'sync': 'list sync', 'op': 'ChanServ op'}
+
+class Timeout(Exception):
+    pass
+
+class Wait(object):
+    """Something a task is waiting for, identified by key"""
+    def __init__(self, key, stage=None, send=None, cancel=None, ready=False, value=None):
+        self.key = key
+        self.stage = stage
+        self.send = send
+        self.cancel = cancel
+        self.ready = ready
+        self.value = value
+        self.tasks = []
+        self.stamp = None
+        self.started = None
+        self.command = None
+        self.retries = 0
+
+    def __iter__(self):
+        return (yield self)
+    __await__ = __iter__
+
+class Task(object):
+    """A generator or coroutine stepped by wake() and sweep()"""
+    def __init__(self, coro, action=None):
+        self.coro = coro
+        self.action = action
+        self.wait = None
+        self.since = None
+
+    def step(self, value=None, error=None):
+        """Resume until the next wait that is not ready yet"""
+        global sweeper
+        while True:
+            try:
+                if error:
+                    wait = self.coro.throw(error)
+                else:
+                    wait = self.coro.send(value)
+            except StopIteration:
+                self.finish()
+                return
+            except Timeout as e:
+                self.finish()
+                if self.action:
+                    self.action.fail(str(e))
+                else:
+                    xchat.emit_print('Server Error', 'Operation failed: %s.' % e)
+                return
+            error = None
+            if wait.ready:
+                if wait.key[0] in cache_stats:
+                    cache_stats[wait.key[0]][0] += 1
+                value = wait.value
+                continue
+
+            self.since = time.time()
+            self.wait = waiting.get(wait.key)
+            if self.wait:
+                self.wait.tasks.append(self)
+                if wait.key[0] in cache_stats:
+                    cache_stats[wait.key[0]][0] += 1
             else:
-                can_run = True
-
-        # Got anything to do?
-        if can_run and not p.actions:
-            p.done()
+                self.wait = waiting[wait.key] = wait
+                wait.tasks.append(self)
+                wait.stamp = wait.started = self.since
+                wait.command = self.action.command if self.action else None
+                if wait.key[0] in cache_stats:
+                    cache_stats[wait.key[0]][1] += 1
+                if not sweeper:
+                    sweeper = xchat.hook_timer(sweep_interval, sweep)
+                if wait.send:
+                    wait.send()
+            return
+
+    def finish(self):
+        self.wait = None
+        if self in tasks:
+            tasks.remove(self)
+
+def spawn(coro, action=None):
+    """Start a task and run it up to its first wait"""
+    task = Task(coro, action)
+    tasks.append(task)
+    task.step()
+    return task
+
+def wake(key, value=None):
+    """Resume all tasks waiting on key"""
+    wait = waiting.pop(key, None)
+    if wait:
+        record_wait(wait)
+        for task in wait.tasks:
+            task.step(value)
+
+def record_wait(wait):
+    """Account the time spent on a finished wait to its stage and actions"""
+    if not wait.stage:
+        return
+    now = time.time()
+    elapsed = now - wait.started
+    entry = stage_waits[wait.stage]
+    entry[0] += 1
+    entry[1] += elapsed
+    entry[2] = max(entry[2], elapsed)
+    for task in wait.tasks:
+        if task.action:
+            task.action.waited[wait.stage] = task.action.waited.get(wait.stage, 0) + now - task.since
+
+def sweep(userdata=None):
+    """Retry or fail waits that have been pending too long"""
+    global sweeper
+    now = time.time()
+    for key, wait in list(waiting.items()):
+        if waiting.get(key) is not wait or not wait.stage:
             continue
-
-        # Am I opped?
-        if can_run:
-            if p.context == just_opped:
-                p.am_op = True
-                p.deop = True
-                p.me_curr = me_curr
-            elif '@' in p.get_prefix():
-                p.am_op = True
+        if now - wait.stamp > stage_deadlines[wait.stage] * 2 ** wait.retries:
+            if wait.retries < stage_retries:
+                wait.retries += 1
+                wait.stamp = now
+                wait.send(retry=True)
             else:
-                p.am_op = False
-
-            if p.needs_op and not p.am_op:
-                can_run = False
-                p.context.command('ChanServ op %s' % p.channel)
+                del waiting[key]
+                record_wait(wait)
+                if wait.cancel:
+                    wait.cancel()
+                error = Timeout('timed out waiting for %s after %d retries' % (stage_names[wait.stage], wait.retries))
+                for task in wait.tasks:
+                    task.step(error=error)
+    if not waiting:
+        sweeper = None
+        return False
+    return True
+
+def whois(context, nick):
+    """Wait for Whois information about nick"""
+    nick = nick.lower()
+    if nick in users:
+        if users[nick].time >= time.time() - 10:
+            return Wait(('whois', nick), ready=True, value=users[nick])
+        del users[nick]
+    def send_whois(retry=False):
+        if retry and nick in resolving_users:
+            resolving_users.remove(nick)
+        if nick not in resolving_users:
+            resolving_users.append(nick)
+            need_replies('whois')
+            send(context, 'whois %s' % nick, wait.command)
+    def cancel():
+        if nick in resolving_users:
+            resolving_users.remove(nick)
+            release_replies('whois')
+    wait = Wait(('whois', nick), 'resolve', send_whois, cancel)
+    return wait
+
+def banlist(context, channel):
+    """Wait for the bans, quiets and AKICKs of a channel"""
+    network = network_name(context.get_info('server'))
+    now = time.time()
+    fresh_bans = channel in ban_stamps and (channel in joined_channels or now - ban_stamps[channel] < ban_cache_ttl)
+    fresh_akicks = channel not in can_do_akick[network] or now - akick_stamps.get(channel, 0) < akick_cache_ttl
+    if fresh_bans and fresh_akicks:
+        return Wait(('bans', channel), ready=True, value=(bans[channel], quiets[channel], akicks[channel]))
+    def send_lists(retry=False):
+        if channel in collecting_bans or channel in collecting_quiets or channel in collecting_akicks:
+            if not retry:
+                return
+            cancel()
+        if not fresh_bans:
+            collecting_bans.append(channel)
+            ban_stamps.pop(channel, None)
+            bans[channel] = []
+            quiets[channel] = []
+            ban_keys[channel] = {}
+            quiet_keys[channel] = {}
+            need_replies('bans')
+            if quiet_mode(network)[0] == 'q':
+                collecting_quiets.append(channel)
+                send(context, 'mode %s +qb' % channel, wait.command)
             else:
-                can_run = True
-
-        # Timeout?
-        if can_run and p.stamp < time.time() - 10:
-            xchat.emit_print('Server Error', 'Operation timed out.')
-            p.done()
+                send(context, 'mode %s +b' % channel, wait.command)
+        if not fresh_akicks:
+            collecting_akicks.append(channel)
+            akick_stamps.pop(channel, None)
+            akicks[channel] = []
+            akick_keys[channel] = {}
+            send(context, 'ChanServ akick %s list' % channel, wait.command)
+    def cancel():
+        for collecting in (collecting_bans, collecting_quiets, collecting_akicks):
+            if channel in collecting:
+                collecting.remove(channel)
+        release_replies('bans')
+    wait = Wait(('bans', channel), 'sync', send_lists, cancel)
+    return wait
+
+def listcounts(context, channel, modes):
+    """Wait for the entry counts of the exception and invite lists in modes"""
+    if channel in count_stamps and (channel in joined_channels or time.time() - count_stamps[channel] < ban_cache_ttl) \
+            and set(modes) <= set(list_counts[channel]):
+        return Wait(('counts', channel), ready=True, value=list_counts[channel])
+    def send_modes(retry=False):
+        collecting_counts[channel] = set(modes)
+        need_replies('bans')
+        count_stamps.pop(channel, None)
+        list_counts[channel] = dict((mode, 0) for mode in modes)
+        send(context, 'mode %s +%s' % (channel, modes), wait.command)
+    def cancel():
+        if collecting_counts.pop(channel, None) is not None:
+            release_replies('bans')
+    wait = Wait(('counts', channel), 'sync', send_modes, cancel)
+    return wait
+
+def lists_done(channel):
+    """Wake the tasks waiting for the lists of a channel once all are in"""
+    if channel not in collecting_bans and channel not in collecting_quiets and channel not in collecting_akicks:
+        wake(('bans', channel), (bans[channel], quiets[channel], akicks[channel]))
+
+def wholist(context, channel):
+    """Wait for the Who list of a channel"""
+    whox = has_whox(network_name(context.get_info('server')))
+    def send_who(retry=False):
+        if channel in collecting_whos:
+            if not retry:
+                return
+            collecting_whos.remove(channel)
+        collecting_whos.append(channel)
+        need_replies('whos')
+        whos[channel] = {}
+        account_members[channel] = {}
+        member_accounts[channel] = {}
+        unknown_accounts.pop(channel, None)
+        whox_rosters.discard(channel)
+        send(context, ('who %s %%cnuhar' if whox else 'who %s') % channel, wait.command)
+    def cancel():
+        if channel in collecting_whos:
+            collecting_whos.remove(channel)
+            release_replies('whos')
+    wait = Wait(('whos', channel), 'sync', send_who, cancel)
+    return wait
+
+def op(context, channel):
+    """Wait until we are opped; the value tells whether ChanServ did it"""
+    if is_opped(context, channel):
+        return Wait(('op', channel), ready=True, value=False)
+    def send_op(retry=False):
+        send(context, 'ChanServ op %s' % channel, wait.command)
+    wait = Wait(('op', channel), 'op', send_op)
+    return wait
+
+def drained():
+    """Wait until the lines queued so far have been sent"""
+    key = ('outbox', next(outbox_ids))
+    def mark(retry=False):
+        outbox.append((None, key, 0))
+        flush_outbox()
+    return Wait(key, send=mark)
+
+def slot(cost):
+    """Wait until the outbox is empty and cost lines may be sent, and
+    count them as sent"""
+    key = ('warm', next(outbox_ids))
+    def mark(retry=False):
+        outbox.append((None, key, cost))
+        flush_outbox()
+    return Wait(key, send=mark)
+
+def gather(waits, action=None):
+    """Wait for all of waits at once, in tasks for action; the value lists
+    their values, None for those that timed out"""
+    if all(wait.ready for wait in waits):
+        return Wait(('gather', None), ready=True, value=[wait.value for wait in waits])
+    key = ('gather', next(outbox_ids))
+    values = [None] * len(waits)
+    left = [len(waits)]
+    def collect(i, wait):
+        try:
+            values[i] = yield wait
+        except Timeout:
+            pass
+        left[0] -= 1
+        if not left[0]:
+            wake(key, values)
+    def start(retry=False):
+        for i, wait in enumerate(waits):
+            spawn(collect(i, wait), action)
+    return Wait(key, send=start)
+
+def warm_up(channel):
+    """Start fetching the lists and Who list of a channel in the background,
+    if we have ChanServ access there and no /cs command is running"""
+    network = network_name(xchat.get_info('server'))
+    if warm_caches and not pending and channel not in warm_ups and \
+            (channel in can_do_akick[network] or channel in can_do_topic[network]):
+        warm_ups.add(channel)
+        spawn(warm_lists(channel))
+
+def warm_lists(channel):
+    """Fetch the lists, then the Who list, of a channel as the outbox allows"""
+    network = network_name(xchat.get_info('server'))
+    for fetch, cost in ((banlist, 2 if channel in can_do_akick[network] else 1), (wholist, 1)):
+        yield slot(cost)
+        if channel not in warm_ups:
+            return
+        if fetch == wholist and roster_known(channel):
+            break
+        try:
+            yield fetch(xchat.find_context(channel=channel) or xchat.get_context(), channel)
+        except Timeout:
+            break
+    warm_ups.discard(channel)
+
+def cancel_warm_ups():
+    """Drop the warm-up fetches not sent yet; those sent are left to finish"""
+    warm_ups.clear()
+    for entry in [entry for entry in outbox if entry[0] is None and entry[1][0] == 'warm']:
+        outbox.remove(entry)
+        wait = waiting.pop(entry[1], None)
+        if wait:
+            for task in wait.tasks:
+                task.finish()
+
+def flush_outbox(userdata=None):
+    """Send queued lines as the token bucket allows"""
+    global outbox_timer, outbox_tokens, outbox_stamp
+    now = time.time()
+    outbox_tokens = min(queue_burst, outbox_tokens + (now - outbox_stamp) * queue_rate)
+    outbox_stamp = now
+    while outbox and outbox_tokens >= (outbox[0][2] if outbox[0][0] is None else 1):
+        context, line, command = outbox.popleft()
+        if context is None:
+            outbox_tokens -= command
+            wake(line)
             continue
-
-        if can_run:
-            p.run()
+        send(context, line, command)
+        outbox_tokens -= 1
+    if not outbox:
+        if outbox_timer and userdata != 'timer':
+            xchat.unhook(outbox_timer)
+        outbox_timer = None
+        return False
+    if not outbox_timer:
+        outbox_timer = xchat.hook_timer(int(1000 / queue_rate), flush_outbox, 'timer')
+    return True
+
+def is_opped(context, channel):
+    if channel == context.get_info('channel'):
+        me = context.get_info('nick')
+        for user in context.get_list('users'):
+            if user.nick == me:
+                return '@' in user.prefix
+    return False
+
+def record_result(action, result):
+    """Store the outcome and latency of a finished action"""
+    latency = time.time() - action.stamp
+    for i, bound in enumerate(latency_buckets):
+        if latency <= bound:
+            break
+    else:
+        i = len(latency_buckets)
+    latencies[i] += 1
+    results.append((action.channel, action.target, result, latency, action.waited))
+
+def print_latency():
+    """Print the latency histogram and recent action results"""
+    total = sum(latencies)
+    xchat.emit_print('Server Text', '\x02Action latency\x02 (%d actions)' % total)
+    lower = 0
+    for bound, count in zip(latency_buckets + [None], latencies):
+        label = '%gs-%gs' % (lower, bound) if bound else '>%gs' % lower
+        xchat.emit_print('Server Text', '%-10s %5d %s' % (label, count, '#' * int(math.ceil(40.0 * count / total)) if count else ''))
+        lower = bound
+    for channel, target, result, latency, waited in results:
+        xchat.emit_print('Server Text', '%s %s: %s (%.2fs%s)' % (channel, target or '-', result, latency,
+            ''.join(', %s %.2fs' % item for item in sorted(waited.items()))))
+
+def send(context, line, command=None):
+    """Send a command, counting it against the /cs command it serves"""
+    lines_sent[command or 'other'] += 1
+    context.command(line)
+
+def timed(callback):
+    """Wrap a hook callback to accumulate its calls and run time"""
+    entry = hook_times.setdefault(callback.__name__, [0, 0.0])
+    def wrapper(word, word_eol, userdata):
+        start = time.perf_counter()
+        try:
+            return callback(word, word_eol, userdata)
+        finally:
+            entry[0] += 1
+            entry[1] += time.perf_counter() - start
+    wrapper.__name__ = callback.__name__
+    return wrapper
+
+def hook_reply(kind, name, callback):
+    """Register a server reply hook, hooked by need_replies(kind)"""
+    reply_hooks[kind].append((name, timed(callback)))
+
+def need_replies(kind):
+    """Hook the replies of a kind, unless hooked already"""
+    if kind not in reply_handles:
+        reply_handles[kind] = [xchat.hook_server(name, callback) for name, callback in reply_hooks[kind]]
+
+def release_replies(kind):
+    """Unhook the replies of a kind once none are being collected"""
+    collecting = {'whois': [resolving_users], 'bans': [collecting_bans, collecting_quiets, collecting_counts],
+                  'whos': [collecting_whos], 'flood': [flood_channels], 'lockdown': [lockdown_channels]}[kind]
+    if kind in reply_handles and not any(collecting):
+        for handle in reply_handles.pop(kind):
+            xchat.unhook(handle)
+
+def watch_channels():
+    """Hook the flood and join counters while channels are watched"""
+    for kind, channels in (('flood', flood_channels), ('lockdown', lockdown_channels)):
+        if channels:
+            need_replies(kind)
+        else:
+            release_replies(kind)
+
+def format_stats():
+    """Queue, wait, cache, traffic, hook and startup statistics as lines of text"""
+    now = time.time()
+    lines = ['\x02Pending\x02: %d action%s, %d wait%s%s' % (len(pending), '' if len(pending) == 1 else 's',
+             len(waiting), '' if len(waiting) == 1 else 's',
+             ', oldest %.1fs' % (now - min(p.stamp for p in pending)) if pending else '')]
+    for p in pending:
+        wait = p.task.wait if p.task else None
+        lines.append('  %s %s %s: %.1fs, %s%s' % (p.channel, p.command, p.target or '-', now - p.stamp,
+                     'waiting for %s %.1fs' % (stage_names.get(wait.stage, 'timer'), now - p.task.since) if wait else 'running',
+                     ''.join(', %s %.2fs' % item for item in sorted(p.waited.items()))))
+    lines.append('\x02Stage waits\x02: ' + ', '.join('%s %d avg %.2fs max %.2fs' %
+                 (stage, count, total / count if count else 0, most) for stage, (count, total, most) in sorted(stage_waits.items())))
+    sizes = {'whois': '%d users' % len(users),
+             'bans': '%d entries in %d channels' % (sum(len(bans[c]) + len(quiets[c]) + len(akicks[c]) for c in bans), len(bans)),
+             'whos': '%d entries in %d channels' % (sum(len(w) for w in whos.values()), len(whos))}
+    names = {'whois': 'Users', 'bans': 'Bans', 'whos': 'Roster'}
+    for kind in ('whois', 'bans', 'whos'):
+        hits, misses = cache_stats[kind]
+        lines.append('\x02%s cache\x02: %s, %d hits, %d misses (%.0f%%)' %
+                     (names[kind], sizes[kind], hits, misses, 100.0 * hits / (hits + misses) if hits + misses else 0))
+    lines.append('\x02Lines sent\x02: ' + (', '.join('%s %d' % item for item in sorted(lines_sent.items())) or 'none'))
+    lines.append('\x02Hooks\x02: ' + ', '.join('%s %d calls %.1fms' % (name, calls, secs * 1000)
+                 for name, (calls, secs) in sorted(hook_times.items(), key=lambda x: -x[1][1]) if calls))
+    lines.append('\x02Startup\x02: loaded in %.1fms, reply hooks in use: %s' %
+                 (load_time * 1000, ', '.join(sorted(reply_handles)) or 'none'))
+    return lines
+
+def dump_stats(userdata=None):
+    """Write the statistics to stats_file"""
+    path = os.path.join(xchat.get_info('xchatdir'), stats_file)
+    try:
+        with open(path, 'w') as f:
+            f.write('%s\n' % time.ctime())
+            for line in format_stats():
+                f.write(line.replace('\x02', '') + '\n')
+    except (IOError, OSError) as e:
+        xchat.emit_print('Server Error', 'Cannot write statistics to %s: %s' % (path, e))
+        return False
+    return True
 
 # Data processing
+def do_welcome(word, word_eol, userdata):
+    """Forget the saved ISUPPORT tokens of a network and the Who lists on
+    connecting"""
+    capabilities.setdefault(network_name(xchat.get_info('server') or word[0][1:]), {})['isupport'] = {}
+    for channel in list(account_members):
+        forget_roster(channel)
+xchat.hook_server('001', timed(do_welcome))
+
+def do_isupport(word, word_eol, userdata):
+    """Remember the ISUPPORT tokens of the server"""
+    network = network_name(xchat.get_info('server'))
+    tokens = capabilities.setdefault(network, {}).setdefault('isupport', {})
+    for token in word[3:]:
+        if token.startswith(':'):
+            break
+        name, _, value = token.partition('=')
+        if name.startswith('-'):
+            tokens.pop(name[1:], None)
+        else:
+            tokens[name] = value
+xchat.hook_server('005', timed(do_isupport))
+
+def do_cap(word, word_eol, userdata):
+    """Remember the CAP capabilities enabled on the server"""
+    if len(word) < 5:
+        return
+    network = network_name(xchat.get_info('server') or word[0][1:])
+    enabled = capabilities.setdefault(network, {}).setdefault('cap', {})
+    subcommand = word[3].upper()
+    names = word_eol[5 if word[4] == '*' and len(word) > 5 else 4].lstrip(':').split()
+    # A connection negotiates from LS on
+    if subcommand == 'LS':
+        enabled.clear()
+    elif subcommand == 'ACK':
+        for name in names:
+            name, _, value = name.partition('=')
+            if name.startswith('-'):
+                enabled.pop(name[1:], None)
+            else:
+                enabled[name] = value
+    elif subcommand == 'DEL':
+        for name in names:
+            enabled.pop(name.partition('=')[0], None)
+xchat.hook_server('CAP', timed(do_cap))
+
+def save_capabilities(word=None, word_eol=None, userdata=None):
+    """Write the capabilities of all networks to capabilities_file"""
+    path = os.path.join(xchat.get_info('xchatdir'), capabilities_file)
+    try:
+        with open(path, 'w') as f:
+            json.dump(capabilities, f, indent=1, sort_keys=True)
+    except (IOError, OSError) as e:
+        xchat.emit_print('Server Error', 'Cannot write capabilities to %s: %s' % (path, e))
+xchat.hook_server('376', timed(save_capabilities)) # End of MOTD
+xchat.hook_server('422', timed(save_capabilities)) # No MOTD
+
+def load_capabilities():
+    """Read the capabilities saved by an earlier session"""
+    path = os.path.join(xchat.get_info('xchatdir'), capabilities_file)
+    try:
+        with open(path) as f:
+            capabilities.update(json.load(f))
+    except (IOError, OSError, ValueError):
+        pass
+
 def do_mode(word, word_eol, userdata):
-    """Run pending actions when ChanServ opped us"""
-    if pending:
-        context = xchat.get_context()
-        me_curr = context.get_info('nick')
-        if word[0] == ':ChanServ!ChanServ@services.' and word[3] == '+o' and word[4] == me_curr:
-            for p in pending:
-                if p.context == context:
-                    run_pending(me_curr = me_curr, just_opped = context)
-                    break
-xchat.hook_server('MODE', do_mode)
+    """Run pending actions when ChanServ opped us, warm up the caches of
+    channels we get opped in otherwise, and follow ban list changes"""
+    channel = word[2]
+    if word[3] == '+o' and len(word) > 4 and word[4] == xchat.get_info('nick'):
+        if ('op', channel) in waiting:
+            if word[0] == ':ChanServ!ChanServ@services.':
+                wake(('op', channel), True)
+        else:
+            warm_up(channel)
+    if channel in count_stamps:
+        network = network_name(xchat.get_info('server'))
+        for sign, letter, mask in parse_modes(network, word):
+            if letter not in list_counts[channel] or not mask:
+                continue
+            elif sign == '-':
+                count_stamps.pop(channel, None)
+                break
+            list_counts[channel][letter] += 1
+    if channel in ban_stamps:
+        network = network_name(xchat.get_info('server'))
+        mapping = casemapping(network)
+        for sign, letter, mask in parse_modes(network, word):
+            if letter not in ('b', 'q') or not mask:
+                continue
+            elif sign == '-':
+                ban_stamps.pop(channel, None)
+                break
+            entries, keys = (bans, ban_keys) if letter == 'b' else (quiets, quiet_keys)
+            key = mask_key(mask, mapping)
+            if keys[channel].get(key) != mask:
+                entries[channel].append(Ban(mask, word[0][1:], int(time.time())))
+                keys[channel].setdefault(key, mask)
+xchat.hook_server('MODE', timed(do_mode))
 
 class User(object):
+    __slots__ = ('nick', 'ident', 'host', 'name', 'account', 'time')
+
     def __init__(self, nick, ident, host, name):
         self.nick = nick
-        self.ident = ident
-        self.host = host
+        self.ident = intern(ident)
+        self.host = intern(host)
         self.name = name
         self.account = None
-        self.time = time.time()
+        self.time = int(time.time())
 def do_whois(word, word_eol, userdata):
     """Store Whois replies in global cache"""
     nick = word[3].lower()
@@ -832,32 +2087,31 @@ def do_whois(word, word_eol, userdata):
         elif word[1] == '307' and not users[nick].account:
             users[nick].account = word[3]
         return xchat.EAT_ALL
-xchat.hook_server('311', do_whois) # User (Whois)
-xchat.hook_server('314', do_whois) # User (Whowas)
-xchat.hook_server('330', do_whois) # Account
-xchat.hook_server('312', do_whois) # Server
-xchat.hook_server('313', do_whois) # Operator
-xchat.hook_server('317', do_whois) # Idle
-xchat.hook_server('301', do_whois) # Away
-xchat.hook_server('319', do_whois) # Channels
-xchat.hook_server('307', do_whois) # Registered
-xchat.hook_server('335', do_whois) # Bot
-xchat.hook_server('379', do_whois) # Modes
-xchat.hook_server('671', do_whois) # Secure
-xchat.hook_server('275', do_whois) # Secure
-xchat.hook_server('276', do_whois) # Certificate
-xchat.hook_server('378', do_whois) # Host
-xchat.hook_server('338', do_whois) # Actually
+hook_reply('whois', '311', do_whois) # User (Whois)
+hook_reply('whois', '314', do_whois) # User (Whowas)
+hook_reply('whois', '330', do_whois) # Account
+hook_reply('whois', '312', do_whois) # Server
+hook_reply('whois', '313', do_whois) # Operator
+hook_reply('whois', '317', do_whois) # Idle
+hook_reply('whois', '301', do_whois) # Away
+hook_reply('whois', '319', do_whois) # Channels
+hook_reply('whois', '307', do_whois) # Registered
+hook_reply('whois', '335', do_whois) # Bot
+hook_reply('whois', '379', do_whois) # Modes
+hook_reply('whois', '671', do_whois) # Secure
+hook_reply('whois', '275', do_whois) # Secure
+hook_reply('whois', '276', do_whois) # Certificate
+hook_reply('whois', '378', do_whois) # Host
+hook_reply('whois', '338', do_whois) # Actually
 
 def do_missing(word, word_eol, userdata):
     """Fall back to Whowas if Whois fails"""
     nick = word[3].lower()
     if nick in resolving_users:
-        for p in pending:
-            if p.target_nickm == nick:
-                p.context.command('whowas %s' % nick)
-                return xchat.EAT_ALL
-xchat.hook_server('401', do_missing)
+        wait = waiting.get(('whois', nick))
+        send(xchat, 'whowas %s' % nick, wait.command if wait else None)
+        return xchat.EAT_ALL
+hook_reply('whois', '401', do_missing)
 
 def do_endwhois(word, word_eol, userdata):
     """Process the queue after nick resolution"""
@@ -865,64 +2119,140 @@ def do_endwhois(word, word_eol, userdata):
     if nick in resolving_users:
         if nick in users:
             resolving_users.remove(nick)
-            run_pending()
+            release_replies('whois')
+            wake(('whois', nick), users[nick])
         return xchat.EAT_ALL
-xchat.hook_server('318', do_endwhois) # Whois
-xchat.hook_server('369', do_endwhois) # Whowas
+hook_reply('whois', '318', do_endwhois) # Whois
+hook_reply('whois', '369', do_endwhois) # Whowas
 
 def do_endwasno(word, word_eol, userdata):
     """Display error if nick cannot be resolved"""
     nick = word[3].lower()
     if nick in resolving_users:
-        for p in pending[:]:
-            if p.target_nickm == nick:
-                xchat.emit_print('Server Error', "Cannot find '%s'" % p.target_nick)
-                pending.remove(p)
-                return xchat.EAT_ALL
-xchat.hook_server('406', do_endwasno)
+        resolving_users.remove(nick)
+        release_replies('whois')
+        wake(('whois', nick), None)
+        return xchat.EAT_ALL
+hook_reply('whois', '406', do_endwasno)
+
+class Ban(object):
+    """An entry of a ban, quiet or AKICK list"""
+    __slots__ = ('mask', 'setter', 'stamp', 'info')
+
+    def __init__(self, mask, setter=None, stamp=0, info=None):
+        self.mask = mask
+        self.setter = setter and intern(setter)
+        self.stamp = stamp
+        self.info = info
+
+    @property
+    def date(self):
+        return time.ctime(self.stamp)[4:]
 
 def do_ban(word, word_eol, userdata):
     """Process banlists"""
     channel = word[3]
     if channel in collecting_bans:
-        ban = [word[4], word[5], time.ctime(float(word[6]))]
+        ban = Ban(word[4], word[5], int(word[6]))
         bans[channel].append(ban)
+        mapping = casemapping(network_name(xchat.get_info('server')))
+        ban_keys[channel].setdefault(mask_key(ban.mask, mapping), ban.mask)
         return xchat.EAT_ALL
-xchat.hook_server('367', do_ban)
+hook_reply('bans', '367', do_ban)
 
 def do_quiet(word, word_eol, userdata):
     """Process banlists"""
     channel = word[3]
-    if channel in collecting_bans:
-        ban = [word[-3], word[-2], time.ctime(float(word[-1]))]
+    if channel in collecting_quiets:
+        ban = Ban(word[-3], word[-2], int(word[-1]))
         quiets[channel].append(ban)
+        mapping = casemapping(network_name(xchat.get_info('server')))
+        quiet_keys[channel].setdefault(mask_key(ban.mask, mapping), ban.mask)
         return xchat.EAT_ALL
-xchat.hook_server('728', do_quiet)
-xchat.hook_server('344', do_quiet)
+hook_reply('bans', '728', do_quiet)
+hook_reply('bans', '344', do_quiet)
 
 def do_endban(word, word_eol, userdata):
     """Process end-of-ban markers"""
     channel = word[3]
     if channel in collecting_bans:
-        if channel not in can_do_akick:
-            collecting_bans.remove(channel)
-            run_pending()
+        collecting_bans.remove(channel)
+        bans_done(channel)
         return xchat.EAT_ALL
-xchat.hook_server('368', do_endban)
+hook_reply('bans', '368', do_endban)
+
+def bans_done(channel):
+    """Mark the ban and quiet lists of a channel fetched once both are in"""
+    if channel not in collecting_bans and channel not in collecting_quiets:
+        ban_stamps[channel] = time.time()
+        release_replies('bans')
+        lists_done(channel)
+
+def do_nochannel(word, word_eol, userdata):
+    """End the lists of a channel that does not exist or are not shown to us"""
+    channel = word[3]
+    if channel in collecting_bans or channel in collecting_quiets:
+        for collecting in (collecting_bans, collecting_quiets):
+            if channel in collecting:
+                collecting.remove(channel)
+        release_replies('bans')
+        lists_done(channel)
+        return xchat.EAT_ALL
+hook_reply('bans', '403', do_nochannel)
+hook_reply('bans', '442', do_nochannel)
 
 def do_endquiet(word, word_eol, userdata):
     """Process end-of-quiet markers"""
     channel = word[3]
-    if channel in collecting_bans:
+    if channel in collecting_quiets:
+        collecting_quiets.remove(channel)
+        bans_done(channel)
         return xchat.EAT_ALL
-xchat.hook_server('729', do_endquiet)
-xchat.hook_server('345', do_endquiet)
+hook_reply('bans', '729', do_endquiet)
+hook_reply('bans', '345', do_endquiet)
+
+list_numerics = {'348': 'e', '349': 'e', '346': 'I', '347': 'I'}
+
+def do_listentry(word, word_eol, userdata):
+    """Count exception and invite list entries"""
+    channel = word[3]
+    if channel in collecting_counts:
+        counts = list_counts[channel]
+        counts[list_numerics[word[1]]] = counts.get(list_numerics[word[1]], 0) + 1
+        return xchat.EAT_ALL
+hook_reply('bans', '348', do_listentry) # Exception
+hook_reply('bans', '346', do_listentry) # Invite
+
+def do_endlist(word, word_eol, userdata):
+    """Process end-of-exception and end-of-invite markers"""
+    channel = word[3]
+    if channel in collecting_counts:
+        collecting_counts[channel].discard(list_numerics[word[1]])
+        if not collecting_counts[channel]:
+            del collecting_counts[channel]
+            count_stamps[channel] = time.time()
+            release_replies('bans')
+            wake(('counts', channel), list_counts[channel])
+        return xchat.EAT_ALL
+hook_reply('bans', '349', do_endlist) # Exception
+hook_reply('bans', '347', do_endlist) # Invite
+
+def do_notop(word, word_eol, userdata):
+    """Give up counting lists that are only listed to ops"""
+    channel = word[3]
+    if channel in collecting_counts:
+        del collecting_counts[channel]
+        release_replies('bans')
+        wake(('counts', channel), None)
+hook_reply('bans', '482', do_notop)
 
 class Who(object):
+    __slots__ = ('target_nick', 'target_ident', 'target_host', 'target_ipaddr', 'target_account', 'target_name')
+
     def __init__(self, nick, ident, host, ipaddr, name, account=None):
         self.target_nick = nick
-        self.target_ident = ident
-        self.target_host = host
+        self.target_ident = intern(ident)
+        self.target_host = intern(host)
         self.target_ipaddr = ipaddr
         self.target_account = account
         self.target_name = name
@@ -932,27 +2262,271 @@ def do_who(word, word_eol, userdata):
     channel = word[3]
     if channel in collecting_whos:
         who = Who(nick = word[7], ident = word[4], host = word[5], ipaddr = get_ipaddr(word[5])[0], name = word_eol[10])
-        whos[channel].append(who)
+        whos[channel][irc_lower(who.target_nick)] = who
+        set_account(channel, who.target_nick, None, known=False)
         return xchat.EAT_ALL
-xchat.hook_server('352', do_who)
+hook_reply('whos', '352', do_who)
 
 def do_whospc(word, word_eol, userdata):
     """Process wholists"""
     channel = word[3]
     if channel in collecting_whos:
         who = Who(nick = word[6], ident = word[4], host = word[5], ipaddr = get_ipaddr(word[5])[0], account = word[7], name = word_eol[8])
-        whos[channel].append(who)
+        whos[channel][irc_lower(who.target_nick)] = who
+        set_account(channel, who.target_nick, who.target_account if who.target_account != '0' else None)
+        whox_rosters.add(channel)
         return xchat.EAT_ALL
-xchat.hook_server('354', do_whospc)
+hook_reply('whos', '354', do_whospc)
 
 def do_endwho(word, word_eol, userdata):
     """Process end-of-who markers"""
     channel = word[3]
     if channel in collecting_whos:
         collecting_whos.remove(channel)
-        run_pending()
+        release_replies('whos')
+        wake(('whos', channel), whos[channel])
         return xchat.EAT_ALL
-xchat.hook_server('315', do_endwho)
+hook_reply('whos', '315', do_endwho)
+
+def forget_roster(channel):
+    """Drop the Who list and account index of a channel, unless being listed"""
+    if channel not in collecting_whos:
+        account_members.pop(channel, None)
+        member_accounts.pop(channel, None)
+        whos.pop(channel, None)
+        unknown_accounts.pop(channel, None)
+        whox_rosters.discard(channel)
+
+def roster_known(channel):
+    """Whether the Who list of a channel is complete and kept current"""
+    return channel in account_members and channel not in collecting_whos
+
+def accounts_known(network, channel):
+    """Whether the account index of a channel is complete and kept current"""
+    return roster_known(channel) and channel in whox_rosters and not unknown_accounts.get(channel) and \
+        'account-notify' in capabilities.get(network, {}).get('cap', {})
+
+def set_account(channel, nick, account, known=True):
+    """Index a channel member under the account it is logged in as"""
+    key = irc_lower(nick)
+    forget_member(channel, key)
+    member_accounts[channel][key] = account and irc_lower(account)
+    if account:
+        account_members[channel].setdefault(irc_lower(account), {})[key] = nick
+    if not known:
+        unknown_accounts[channel].add(key)
+
+def forget_member(channel, key):
+    if channel in unknown_accounts:
+        unknown_accounts[channel].discard(key)
+    account = member_accounts[channel].pop(key, None)
+    if account:
+        nicks = account_members[channel][account]
+        del nicks[key]
+        if not nicks:
+            del account_members[channel][account]
+
+def on_join(word, word_eol, userdata):
+    """Add joining users to the Who list, with their account if extended-join
+    tells, and warm up the caches of channels we join"""
+    channel = word[2].lstrip(':')
+    if word[0].startswith(':%s!' % xchat.get_info('nick')):
+        # Changes made while we were away were not seen
+        joined_channels.add(channel)
+        ban_stamps.pop(channel, None)
+        count_stamps.pop(channel, None)
+        forget_roster(channel)
+        warm_up(channel)
+    if channel in account_members:
+        nick, _, host = word[0][1:].partition('!')
+        ident, _, host = host.partition('@')
+        extended = len(word) > 4
+        account = word[3] if extended and word[3] != '*' else None
+        who = Who(nick = nick, ident = ident, host = host, ipaddr = get_ipaddr(host)[0],
+                  account = (account or '0') if extended else None, name = word_eol[4][1:] if extended else '')
+        whos[channel][irc_lower(nick)] = who
+        set_account(channel, nick, account, known=extended)
+xchat.hook_server('JOIN', timed(on_join))
+
+def on_account(word, word_eol, userdata):
+    """Move users who log in or out to their new account"""
+    nick = word[0][1:].split('!', 1)[0]
+    account = word[2].lstrip(':')
+    for channel in account_members:
+        if irc_lower(nick) in member_accounts[channel]:
+            set_account(channel, nick, account if account != '*' else None)
+xchat.hook_server('ACCOUNT', timed(on_account))
+
+def on_nick(word, word_eol, userdata):
+    """Follow nick changes in the Who lists and account indexes"""
+    nick, new = irc_lower(word[0][1:].split('!', 1)[0]), word[2].lstrip(':')
+    for channel in account_members:
+        if nick in member_accounts[channel]:
+            account = member_accounts[channel][nick]
+            known = nick not in unknown_accounts.get(channel, ())
+            forget_member(channel, nick)
+            set_account(channel, new, account, known)
+        who = whos[channel].pop(nick, None)
+        if who:
+            who.target_nick = new
+            whos[channel][irc_lower(new)] = who
+xchat.hook_server('NICK', timed(on_nick))
+
+def on_part(word, word_eol, userdata):
+    """Drop users leaving a channel from its Who list and account index"""
+    if word[1] == 'KICK':
+        channel, nick = word[2], word[3]
+    else:
+        channel, nick = word[2].lstrip(':'), word[0][1:].split('!', 1)[0]
+    if nick == xchat.get_info('nick'):
+        joined_channels.discard(channel)
+        ban_stamps.pop(channel, None)
+        count_stamps.pop(channel, None)
+    if channel not in account_members:
+        return
+    if nick == xchat.get_info('nick'):
+        forget_roster(channel)
+    else:
+        forget_member(channel, irc_lower(nick))
+        whos[channel].pop(irc_lower(nick), None)
+xchat.hook_server('PART', timed(on_part))
+xchat.hook_server('KICK', timed(on_part))
+
+def on_quit(word, word_eol, userdata):
+    """Drop users quitting from all Who lists and account indexes"""
+    nick = irc_lower(word[0][1:].split('!', 1)[0])
+    for channel in account_members:
+        forget_member(channel, nick)
+        whos[channel].pop(nick, None)
+xchat.hook_server('QUIT', timed(on_quit))
+
+def count_flood(word, word_eol, userdata):
+    """Count messages, joins and nick changes on flood_channels towards floods"""
+    if not flood_channels:
+        return
+    nick, _, host = word[0][1:].partition('!')
+    host = host.partition('@')[2]
+    now = time.time()
+    if word[1] == 'NICK':
+        if flood_hit(('nick', None, host), flood_joins, now):
+            for channel in flood_channels:
+                quiet_flooder(channel, nick, host, now)
+        return
+    channel = word[2].lstrip(':')
+    if channel not in flood_channels:
+        return
+    if word[1] == 'JOIN':
+        flooding = flood_hit(('join', channel, host), flood_joins, now)
+    else:
+        flooding = (flood_hit(('lines', channel, host), flood_lines, now) or
+                    flood_hit(('repeats', channel, hash(word_eol[3].lower())), flood_repeats, now))
+    if flooding:
+        quiet_flooder(channel, nick, host, now)
+hook_reply('flood', 'PRIVMSG', count_flood)
+hook_reply('flood', 'NOTICE', count_flood)
+hook_reply('flood', 'JOIN', count_flood)
+hook_reply('flood', 'NICK', count_flood)
+
+class JoinRate(object):
+    """Joins per second over the last seconds, for a rolling count"""
+    __slots__ = ('buckets', 'second', 'total')
+
+    def __init__(self, seconds):
+        self.buckets = [0] * seconds
+        self.second = 0
+        self.total = 0
+
+    def add(self, now):
+        """Count a join; the joins within the window"""
+        second = int(now)
+        if second - self.second >= len(self.buckets):
+            self.buckets = [0] * len(self.buckets)
+            self.total = 0
+        else:
+            for passed in range(self.second + 1, second + 1):
+                i = passed % len(self.buckets)
+                self.total -= self.buckets[i]
+                self.buckets[i] = 0
+        self.second = max(self.second, second)
+        self.buckets[second % len(self.buckets)] += 1
+        self.total += 1
+        return self.total
+
+def count_joins(word, word_eol, userdata):
+    """Lock down channels in lockdown_channels on join floods"""
+    channel = word[2].lstrip(':')
+    if channel not in lockdown_channels or word[0][1:].split('!', 1)[0] == xchat.get_info('nick'):
+        return
+    rate = join_rates.get(channel)
+    if rate is None:
+        rate = join_rates[channel] = JoinRate(lockdown_joins[1])
+    now = time.time()
+    if rate.add(now) < lockdown_joins[0]:
+        return
+    if channel not in lockdowns:
+        xchat.emit_print('Server Text', 'Join flood in %s, setting %s.' % (channel, lockdown_modes))
+        cs(['cs', 'mode', channel] + lockdown_modes.split(), None, None)
+        xchat.hook_timer(lockdown_period * 1000, lift_lockdown, channel)
+    lockdowns[channel] = now
+hook_reply('lockdown', 'JOIN', count_joins)
+
+def lift_lockdown(channel):
+    """Unset the lockdown modes once a channel had no join flood for lockdown_period"""
+    calm = time.time() - lockdowns[channel]
+    if calm < lockdown_period:
+        xchat.hook_timer(int((lockdown_period - calm) * 1000) + 1, lift_lockdown, channel)
+        return False
+    del lockdowns[channel]
+    xchat.emit_print('Server Text', 'Join flood in %s is over, unsetting %s.' % (channel, lockdown_modes))
+    cs(['cs', 'mode', channel, '-' + lockdown_modes.split()[0].lstrip('+')], None, None)
+    return False
+
+def flood_hit(key, limit, now):
+    """Add an event to the ring of key; whether it holds limit[0] events
+    within limit[1] seconds"""
+    global flood_pruner
+    ring = flood_rings.get(key)
+    if ring is None:
+        ring = flood_rings[key] = collections.deque(maxlen=limit[0])
+        if not flood_pruner:
+            flood_pruner = xchat.hook_timer(60000, prune_floods)
+    ring.append(now)
+    return len(ring) == limit[0] and now - ring[0] <= limit[1]
+
+def prune_floods(userdata=None):
+    """Forget rings and quieted hosts that can no longer matter"""
+    global flood_pruner
+    now = time.time()
+    window = max(flood_lines[1], flood_joins[1], flood_repeats[1])
+    for key, ring in list(flood_rings.items()):
+        if now - ring[-1] > window:
+            del flood_rings[key]
+    for key, until in list(flood_quieted.items()):
+        if until <= now:
+            del flood_quieted[key]
+    if not flood_rings and not flood_quieted:
+        flood_pruner = None
+        return False
+    return True
+
+def quiet_flooder(channel, nick, host, now):
+    """Quiet a flooding host for flood_quiet minutes, unless done already
+    or the nick is an op or ourselves"""
+    if flood_quieted.get((channel, host), 0) > now:
+        return
+    context = xchat.find_context(channel=channel)
+    if not context or nick == context.get_info('nick'):
+        return
+    for user in context.get_list('users'):
+        if irc_lower(user.nick) == irc_lower(nick):
+            if '@' in user.prefix:
+                return
+            break
+    else:
+        return
+    flood_quieted[(channel, host)] = now + flood_quiet * 60
+    context.emit_print('Server Text', 'Flood from \x02%s\x02 in %s, quieting for %d minutes.' % (nick, channel, flood_quiet))
+    cs(['cs', 'quiet', channel, '-t%d' % flood_quiet, '*!*@%s' % host], None, None)
 
 def rejoin(word, word_eol, userdata):
     """Rejoin when /remove'd"""
@@ -964,24 +2538,36 @@ def on_invite(word, word_eol, userdata):
     """Autojoin when ChanServ invites us"""
     if word[0] == ':ChanServ!ChanServ@services.':
         xchat.command('join %s' % word[-1][1:])
-xchat.hook_server('INVITE', on_invite)
+xchat.hook_server('INVITE', timed(on_invite))
 
 def on_notice(word, word_eol, userdata):
     global current_akick
     # NickServ notices
     if word[0] == ':NickServ!NickServ@services.':
+        network = network_name(xchat.get_info('server'))
         if re.match(r'^:\+?Access flag\(s\)', word_eol[3]):
+            akick, topic = collecting_access.get(network) or (can_do_akick[network], can_do_topic[network])
             if 'f' in word[5]:
-                can_do_akick.append(word[-1])
+                akick.add(word[-1])
             if 't' in word[5]:
-                can_do_topic.append(word[-1])
-            if xchat.get_info('server') in collecting_access:
+                topic.add(word[-1])
+            if network in collecting_access:
                 return xchat.EAT_ALL
-        elif re.match(r'^channel access matches for the nickname', word_eol[4]):
-            server = xchat.get_info('server')
-            if server in collecting_access:
-                collecting_access.remove(server)
+        elif re.search(r'channel access (matches|was found) for the nickname', word_eol[3]):
+            if network in collecting_access:
+                can_do_akick[network], can_do_topic[network] = collecting_access.pop(network)
+                save_access(network)
+                # AKICK lists we may no longer see will not come
+                for channel in [c for c in collecting_akicks if c not in can_do_akick[network]]:
+                    collecting_akicks.remove(channel)
+                    lists_done(channel)
+                for chan in xchat.get_list('channels'):
+                    if chan.type == 2 and network_name(chan.server) == network:
+                        warm_up(chan.channel)
                 return xchat.EAT_ALL
+        elif re.match(r'^:\+?You are now identified for', word_eol[3]):
+            logged_in[network] = word[-1].strip('\x02.')
+            listchans()
 
     # ChanServ notices
     elif word[0] == ':ChanServ!ChanServ@services.':
@@ -989,57 +2575,167 @@ def on_notice(word, word_eol, userdata):
             xchat.command('join %s' % word[6][1:-1])
         elif re.match(r'^:\+?Channel [^ ]+ key is:', word_eol[3]):
             xchat.command('join %s %s' % (word[4][1:-1], word[-1]))
+        elif re.match(r'^:\+?You are not authorized', word_eol[3]):
+            # Our access changed since it was last listed. If it answers an
+            # AKICK list, by its header, channel or command, bans there go on
+            # without AKICK
+            network = network_name(xchat.get_info('server'))
+            words = [w.strip('\x02.,:') for w in word_eol[3].split()]
+            named = [c for c in collecting_akicks if c in words]
+            channel = current_akick or (named[0] if named else None) or \
+                (collecting_akicks[0] if collecting_akicks and 'AKICK' in word_eol[3].upper() else None)
+            if channel in collecting_akicks:
+                current_akick = None
+                can_do_akick[network].discard(channel)
+                collecting_akicks.remove(channel)
+                lists_done(channel)
+            refresh_access(network)
 
-        # Yay heuristics. Chances are reasonable that only one channel is in
-        # collecting_bans at any time, so let's assume that. Worst that could
-        # happen is that non-existing bans are shown or removal of them is tried.
+        # ChanServ answers in order, so the entries that follow a header
+        # are those of the channel it names
         elif re.match(r'^:\+?AKICK list', word_eol[3]):
             current_akick = word[-1][1:-2]
-            if current_akick in collecting_bans:
+            if current_akick in collecting_akicks:
                 return xchat.EAT_ALL
             else:
                 current_akick = None
 
         elif current_akick and '[setter:' in word_eol[0] and 'modified:' in word_eol[0]:
             # This looks like a ban to me. So everybody, just follow me.
-            ban = [word[4][1:-1], word_eol[4]]
+            ban = Ban(word[4][1:-1], info=word_eol[4])
             akicks[current_akick].append(ban)
+            mapping = casemapping(network_name(xchat.get_info('server')))
+            akick_keys[current_akick].setdefault(mask_key(ban.mask, mapping), ban.mask)
             return xchat.EAT_ALL
 
-        elif current_akick and word_eol[9] == 'AKICK list.':
+        elif current_akick and len(word) > 9 and word_eol[9] == 'AKICK list.':
             current_akick = None
             channel = word[-3][1:-3]
-            if channel in can_do_akick:
-                collecting_bans.remove(channel)
-                run_pending()
+            if channel in collecting_akicks:
+                collecting_akicks.remove(channel)
+                akick_stamps[channel] = time.time()
+                lists_done(channel)
             return xchat.EAT_ALL
 
+        # Confirmations of our own AKICK changes
+        else:
+            added = re.match(r'^(?:AKICK on |)\x02([^ ]+)\x02 (?:has been|was successfully) added (?:to the AKICK list |)for \x02([^ ]+)\x02',
+                             word_eol[3].lstrip(':+'))
+            deleted = re.match(r'^\x02([^ ]+)\x02 has been (?:removed|deleted) from the AKICK list for \x02([^ ]+)\x02',
+                               word_eol[3].lstrip(':+'))
+            if added or deleted:
+                mask, channel = (added or deleted).groups()
+                update_akicks(channel, mask, bool(added))
+
         # Print all other ChanServ notices in current tab
         xchat.emit_print('Notice', 'ChanServ', word_eol[3].lstrip(':+'))
         return xchat.EAT_ALL
-xchat.hook_server('NOTICE', on_notice)
+xchat.hook_server('NOTICE', timed(on_notice))
+
+def update_akicks(channel, mask, added):
+    """Apply a confirmed AKICK change to the cached AKICK list of a channel"""
+    mapping = casemapping(network_name(xchat.get_info('server')))
+    key = mask_key(mask, mapping)
+    reason = akicks_sent.pop((channel, mask_key(mask)), '')
+    if channel not in akick_stamps:
+        return
+    elif reason.startswith('!t '):
+        # Timed AKICKs expire without a word from ChanServ
+        del akick_stamps[channel]
+        return
+    entries = [entry for entry in akicks[channel] if mask_key(entry.mask, mapping) != key]
+    if added:
+        entries.append(Ban(mask, info='\x02%s\x02 (%s) [setter: %s, modified: now]' % (mask, reason, xchat.get_info('nick'))))
+        akick_keys[channel][key] = mask
+    else:
+        akick_keys[channel].pop(key, None)
+    akicks[channel] = entries
 
 def listchans(word=None, word_eol=None, userdata=None):
-    if not word:
-        server = xchat.get_info('server')
-        if not server:
-            return xchat.EAT_ALL
+    """Take channel access from access_file, and from NickServ if stale;
+    at load, stale access is used until the first /cs command fetches it"""
+    server = xchat.get_info('server')
+    if not server or network_name(server) not in atheme_networks:
+        return
+    network = network_name(server)
+    saved = read_access().get(access_key(network))
+    if saved:
+        can_do_akick[network] = set(saved['akick'])
+        can_do_topic[network] = set(saved['topic'])
+    if saved and time.time() - saved['stamp'] < access_ttl:
+        return
+    if userdata == 'load':
+        access_deferred.add(network)
     else:
-        server = word[0][1:]
-    if server.split('.')[-2] in atheme_networks:
-        collecting_access.append(server)
+        access_deferred.discard(network)
+        refresh_access(network)
+xchat.hook_server('376', timed(listchans))
+
+def refresh_access(network):
+    """List our channel access with NickServ, unless already doing so"""
+    if network not in collecting_access:
+        collecting_access[network] = (set(), set())
         xchat.command('NickServ listchans')
-xchat.hook_server('376', listchans)
+
+def do_loggedin(word, word_eol, userdata):
+    """Remember the account we logged in as"""
+    logged_in[network_name(xchat.get_info('server') or word[0][1:])] = word[4]
+xchat.hook_server('900', timed(do_loggedin))
+
+def access_key(network):
+    return '%s %s' % (network, irc_lower(logged_in.get(network) or xchat.get_info('nick')))
+
+def read_access():
+    """The saved channel access, by access_key()"""
+    path = os.path.join(xchat.get_info('xchatdir'), access_file)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def save_access(network):
+    """Save the channel access on a network to access_file"""
+    saved = read_access()
+    saved[access_key(network)] = {'stamp': time.time(), 'akick': sorted(can_do_akick[network]),
+                                  'topic': sorted(can_do_topic[network])}
+    path = os.path.join(xchat.get_info('xchatdir'), access_file)
+    try:
+        with open(path, 'w') as f:
+            json.dump(saved, f, indent=1, sort_keys=True)
+    except (IOError, OSError) as e:
+        xchat.emit_print('Server Error', 'Cannot write channel access to %s: %s' % (path, e))
 
 def loadevent(userdata=None, event='unloaded'):
     print('%s v%s %s' % (__module_name__, __module_version__, event))
 xchat.hook_unload(loadevent)
 
-# Fetch channel access
-listchans()
+# Capabilities known from the last session
+load_capabilities()
+
+# Take channel access, if saved
+listchans(userdata='load')
+
+# Follow the ban lists of the channels we are on
+joined_channels.update(chan.channel for chan in xchat.get_list('channels') if chan.type == 2)
+
+# Count floods and joins on the watched channels
+watch_channels()
+
+# Dump statistics periodically
+if stats_file:
+    xchat.hook_timer(stats_interval * 1000, dump_stats)
 
-# Turn on autorejoin
-#xchat.command('set -quiet irc_auto_rejoin ON')
+# Turn on autorejoin the first time we get kicked, not at load
+def auto_rejoin(word, word_eol, userdata):
+    """Turn on autorejoin before XChat handles our first kick"""
+    global auto_rejoin_hook
+    if word[3] == xchat.get_info('nick') and auto_rejoin_hook:
+        xchat.command('set -quiet irc_auto_rejoin ON')
+        xchat.unhook(auto_rejoin_hook)
+        auto_rejoin_hook = None
+auto_rejoin_hook = None
+#auto_rejoin_hook = xchat.hook_server('KICK', auto_rejoin)
 
 # Unban when muted
 xchat.hook_server('404', lambda word, word_eol, userdata: xchat.command('ChanServ unban %s' % word[3]))
@@ -1054,4 +2750,5 @@ xchat.hook_server('475', lambda word, word_eol, userdata: xchat.command('ChanSer
 xchat.hook_server('482', lambda word, word_eol, userdata: xchat.emit_print('Server Error', word_eol[3]))
 
 xchat.hook_command('cs', cs, 'For help with /cs, please read the comments in the script')
+load_time = time.perf_counter() - load_started
 loadevent(event='loaded')
@@ -45,6 +45,8 @@
 # m  or mode    - Change channel mode (/cs mode modes here)
 # i  or invite  - Invite yourself or someone else (/cs invite [nick])
 # bans          - Show bans that apply to someone without removing them (/cs bans nick)
+# tr or trace   - Show recent action traces, or export them as JSON lines or
+#                 Chrome trace format (/cs trace, /cs trace json|chrome file)
 #
 # * Bans, forwards and mute take an extra optional argument that specifies
 #   what should be banned: nickname, ident, host, account and/or realname.
@@ -72,6 +74,8 @@ __module_version__     = "2.3.3"
 __module_description__ = "Chanserv helper"
 
 import collections
+import itertools
+import json
 import xchat
 import time
 import re
@@ -89,11 +93,21 @@ akicks = collections.defaultdict(list)
 collecting_bans = []
 current_akick = None
 can_do_akick = []
+# Whether channel access was asked from NickServ since connecting; at load
+# that is left to the first /cs command
+listed_access = False
+# Stale action sweeper
+timeout = 10
+sweeper = None
+# Action trace ring buffer: (stamp, action id, channel, target, event, detail)
+trace_size = 2000
+traces = collections.deque(maxlen=trace_size)
+action_ids = itertools.count(1)
 
 abbreviations = {'kick': 'k', 'ban': 'b', 'kickban': 'kb', 'forward': 'f',
                  'kickforward': 'kf', 'mute': 'm', 'topic': 't', 'unban': 'u',
                  'mode': 'm', 'invite': 'i', 'op': 'o', 'deop': 'd', 'lart': 'l',
-                 'voice': 'v', 'devoice': 'dv', 'bans': 'bans'}
+                 'voice': 'v', 'devoice': 'dv', 'bans': 'bans', 'trace': 'tr'}
 expansions = dict([x[::-1] for x in abbreviations.items()])
 simple_commands = ['op', 'deop', 'voice', 'devoice']
 kick_commands = ['kick', 'kickforward', 'kickban', 'lart']
@@ -117,6 +131,12 @@ def cs(word, word_eol, userdata):
     if command not in all_commands:
         return xchat.EAT_NONE
 
+    if command in ('tr', 'trace'):
+        return show_trace(word[2:])
+
+    if not listed_access:
+        listchans()
+
     args = dict(enumerate(word_eol[2:]))
     me = xchat.get_info('nick')
 
@@ -244,6 +264,7 @@ class Action(object):
         self.me = me
         self.context = context
         self.stamp = time.time()
+        self.id = next(action_ids)
 
         # Defaults
         self.deop = True
@@ -267,11 +288,13 @@ class Action(object):
 
     def schedule(self, update_stamp=False):
         """Request information and add ourselves to the queue"""
-        if debug:
-            xchat.emit_print('Server Text', "Scheduling " + str(self))
+        global sweeper
         if update_stamp:
             self.stamp = time.time()
+        trace(self, 'reschedule' if update_stamp else 'parse', str(self), self.stamp)
         pending.append(self)
+        if not sweeper:
+            sweeper = xchat.hook_timer(1000, sweep)
         # Am I opped?
         self.am_op = False
         for user in self.context.get_list('users'):
@@ -280,7 +303,7 @@ class Action(object):
                 self.deop = False
 
         if self.needs_op and not self.am_op:
-            self.context.command("chanserv op %s" % self.channel)
+            self.send("chanserv op %s" % self.channel)
 
         # Find needed information
         if ('a' in self.bans or 'r' in self.bans) and valid_mask(self.target) and not self.target.startswith('$'):
@@ -323,7 +346,7 @@ class Action(object):
             if users[self.target_nick].time < time.time() - 10:
                 del users[self.target_nick]
                 if request:
-                    self.context.command('whois %s' % self.target_nick)
+                    self.send('whois %s' % self.target_nick)
             else:
                 self.target_ident = users[self.target_nick].ident
                 self.target_host = users[self.target_nick].host
@@ -337,19 +360,23 @@ class Action(object):
                     self.actions.remove('mode %(channel)s +%(banmode)s *!*@%(target_host)s%(forward_to)s')
         else:
             if request:
-                self.context.command('whois %s' % self.target_nick)
+                self.send('whois %s' % self.target_nick)
 
     def fetch_bans(self):
         """Read bans for a channel"""
         bans[self.channel] = []
         quiets[self.channel] = []
         collecting_bans.append(self.channel)
-        self.context.command("mode %s +bq" % self.channel)
+        self.send("mode %s +bq" % self.channel)
+
+    def send(self, line):
+        """Send a command on behalf of this action"""
+        trace(self, 'send', line)
+        self.context.command(line)
 
     def run(self):
         """Perform our actions"""
-        if debug:
-            xchat.emit_print('Server Text', "Running " + str(self))
+        trace(self, 'run', str(self))
         kwargs = dict(self.__dict__.items())
 
         if self.do_bans:
@@ -387,30 +414,32 @@ class Action(object):
             if self.channel in can_do_akick and self.timer and ' +b ' in action:
                 timer = math.ceil(self.timer/60.0)
                 ban = action.split()[-1]
-                self.context.command("chanserv akick %s ADD %s !T %d" % (self.channel, ban, timer))
+                self.send("chanserv akick %s ADD %s !T %d" % (self.channel, ban, timer))
             else:
-                self.context.command(action)
+                self.send(action)
 
         self.done()
 
     def done(self):
         """Finaliazation and cleanup"""
         # Done!
-        if debug:
-            xchat.emit_print('Server Text', "Done " + str(self))
+        trace(self, 'done')
         pending.remove(self)
 
         # Deop?
         if not self.am_op or not self.needs_op:
             return
 
+        now = time.time()
         for p in pending:
-            if p.channel == self.channel and p.needs_op or not p.deop:
+            if p.stamp < now - timeout:
+                continue
+            if p.channel == self.channel and (p.needs_op or not p.deop):
                 self.deop = False
                 break
 
         if self.deop:
-            self.context.command("chanserv deop %s" % self.channel)
+            self.send("chanserv deop %s" % self.channel)
 
         # Schedule removal?
         if self.timer and (self.channel not in can_do_akick or self.banmode == 'q'):
@@ -444,7 +473,7 @@ def run_pending(just_opped = None):
     """Check all actions and run them if all information is there"""
     now = time.time()
 
-    for p in pending:
+    for p in pending[:]:
         if p.channel == just_opped:
             p.am_op = True
 
@@ -452,7 +481,8 @@ def run_pending(just_opped = None):
             p.resolve_nick(request = False)
 
         # Timeout?
-        if p.stamp < now - 10:
+        if p.stamp < now - timeout:
+            trace(p, 'timeout', str(p))
             p.done()
             continue
 
@@ -460,6 +490,71 @@ def run_pending(just_opped = None):
         if can_run and p.resolved and (p.am_op or not p.needs_op):
             p.run()
 
+def sweep(userdata=None):
+    """Expire stale actions even when no server events arrive"""
+    global sweeper
+    run_pending()
+    if not pending:
+        sweeper = None
+        return False
+    return True
+
+# Tracing
+def trace(action, event, detail='', stamp=None):
+    """Record an event of an action, and show it when debugging"""
+    traces.append((stamp or time.time(), action.id, action.channel, action.target, event, detail))
+    if debug:
+        xchat.emit_print('Server Text', "[%d] %s %s" % (action.id, event, detail))
+
+def trace_reply(reply, channel=None, nick=None):
+    """Record a server reply for the pending actions it advances"""
+    for p in pending:
+        if (channel and p.channel == channel) or (nick and p.target.lower() == nick):
+            trace(p, 'reply', reply)
+
+def show_trace(args):
+    """Print recent traces, or export them to a file"""
+    if not args:
+        for stamp, id, channel, target, event, detail in list(traces)[-50:]:
+            xchat.emit_print('Server Text', "%s.%03d [%d] %s %s: %s %s" % (time.strftime('%H:%M:%S', time.localtime(stamp)),
+                int(stamp * 1000) % 1000, id, channel, target, event, detail))
+        return xchat.EAT_ALL
+    if args[0] not in ('json', 'chrome') or len(args) < 2:
+        xchat.emit_print('Server Error', "Usage: /cs trace [json|chrome file]")
+        return xchat.EAT_ALL
+    path = os.path.join(xchat.get_info('xchatdir'), os.path.expanduser(args[1]))
+    try:
+        with open(path, 'w') as fd:
+            if args[0] == 'json':
+                for stamp, id, channel, target, event, detail in traces:
+                    fd.write(json.dumps({'ts': stamp, 'action': id, 'channel': channel, 'target': target,
+                                         'event': event, 'detail': detail}) + '\n')
+            else:
+                json.dump({'traceEvents': chrome_trace(), 'displayTimeUnit': 'ms'}, fd)
+    except (IOError, OSError) as e:
+        xchat.emit_print('Server Error', "Could not write %s: %s" % (path, e))
+        return xchat.EAT_ALL
+    xchat.emit_print('Server Text', "Wrote %d trace events to %s" % (len(traces), path))
+    return xchat.EAT_ALL
+
+def chrome_trace():
+    """Traces as Chrome trace events: one row per action, a slice for the
+    time leading up to each event and an instant event for each event"""
+    events = []
+    last = {}
+    for stamp, id, channel, target, event, detail in traces:
+        ts = int(stamp * 1000000)
+        if id not in last:
+            events.append({'ph': 'M', 'name': 'thread_name', 'pid': 1, 'tid': id,
+                           'args': {'name': '%d %s %s' % (id, channel, target)}})
+        else:
+            events.append({'ph': 'X', 'name': event, 'pid': 1, 'tid': id, 'ts': last[id],
+                           'dur': ts - last[id], 'args': {'detail': detail}})
+        events.append({'ph': 'i', 's': 't', 'name': event, 'pid': 1, 'tid': id, 'ts': ts,
+                       'args': {'detail': detail}})
+        last[id] = ts
+    return events
+
 # Helper functions
 def ban2re(data):
     return re.compile('^' + re.escape(data).replace(r'\*','.*').replace(r'\?','.') + '$')
@@ -476,6 +571,7 @@ def do_mode(word, word_eol, userdata):
     """Run pending actions when chanserv opped us"""
     ctx = xchat.get_context()
     if 'chanserv!' in word[0].lower() and '+o' in word[3] and ctx.get_info('nick') in word:
+        trace_reply('op', channel=ctx.get_info('channel'))
         run_pending(just_opped = ctx.get_info('channel'))
 xchat.hook_server('MODE', do_mode)
 
@@ -487,6 +583,7 @@ class User(object):
 def do_whois(word, word_eol, userdata):
     """Store whois replies in global cache"""
     nick = word[3].lower()
+    trace_reply(word[1], nick=nick)
     if word[1] == '330':
         users[nick].account = word[4]
     else:
@@ -499,7 +596,8 @@ def do_missing(word, word_eol, userdata):
     """Fall back to whowas if whois fails"""
     for p in pending:
         if p.target == word[3]:
-            p.context.command('whowas %s' % word[3])
+            trace(p, 'reply', '401')
+            p.send('whowas %s' % word[3])
             break
 xchat.hook_server('401', do_missing)
 
@@ -508,11 +606,13 @@ def do_endwas(word, word_eol, userdata):
     for p in pending:
         if p.target == word[3]:
             xchat.emit_print("Server Error", "%s could not be found" % p.target)
+            trace(p, 'notfound', '406')
             pending.remove(p)
 xchat.hook_server('406', do_endwas)
 
 def endofwhois(word, word_eol, userdata):
     """Process the queue after nickname resolution"""
+    trace_reply(word[1], nick=word[3].lower())
     run_pending()
 xchat.hook_server('318', endofwhois)
 xchat.hook_server('369', endofwhois)
@@ -541,6 +641,7 @@ def do_endban(word, word_eol, userdata):
     """Process end-of-ban markers"""
     channel = word[3]
     if channel in collecting_bans:
+        trace_reply('368', channel=channel)
         return xchat.EAT_ALL
     return xchat.EAT_NONE
 xchat.hook_server('368', do_endban)
@@ -549,13 +650,21 @@ def do_endquiet(word, word_eol, userdata):
     """Process end-of-quiet markers"""
     channel = word[3]
     if channel in collecting_bans:
+        trace_reply('729', channel=channel)
         xchat.command('quote cs akick %s list' % channel)
         return xchat.EAT_ALL
     return xchat.EAT_NONE
 xchat.hook_server('729', do_endquiet)
 
-# Turn on autorejoin
-xchat.command('SET -quiet irc_auto_rejoin ON')
+# Turn on autorejoin the first time we get kicked, not at load
+def auto_rejoin(word, word_eol, userdata):
+    """Turn on autorejoin before XChat handles our first kick"""
+    global auto_rejoin_hook
+    if word[3] == xchat.get_info('nick') and auto_rejoin_hook:
+        xchat.command('SET -quiet irc_auto_rejoin ON')
+        xchat.unhook(auto_rejoin_hook)
+        auto_rejoin_hook = None
+auto_rejoin_hook = xchat.hook_server('KICK', auto_rejoin)
 
 def rejoin(word, word_eol, userdata):
     """Rejoin when /remove'd"""
@@ -622,12 +731,17 @@ def on_notice(word, word_eol, userdata):
         current_akick = None
         channel = word[-3][1:-3]
         collecting_bans.remove(channel)
+        trace_reply('AKICK list', channel=channel)
         run_pending()
         return xchat.EAT_ALL
 
 xchat.hook_server('NOTICE', on_notice)
 # Fetch channel access
-xchat.command('quote ns listchans')
-xchat.hook_server('376', lambda w, we, u: xchat.command('quote ns listchans'))
+def listchans(word=None, word_eol=None, userdata=None):
+    """Ask NickServ for our channel access"""
+    global listed_access
+    listed_access = True
+    xchat.command('quote ns listchans')
+xchat.hook_server('376', listchans)
 
 xchat.emit_print('Server Text',"Loaded %s %s by Seveas <dennis@kaarsemaker.net>" % (__module_description__, __module_version__))
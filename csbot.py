@@ -0,0 +1,224 @@
+#!/usr/bin/python3
+#
+# Headless runner for the ChanServ helper script
+#
+# Loads chanserv.1.py without XChat: an asyncio IRC client talks raw IRC
+# over a socket and feeds every line to the script's hooks through an
+# xchat-compatible shim. One process serves any number of channels on one
+# connection, sharing the script's caches and a single rate-limited
+# outbound queue.
+#
+#   python3 csbot.py --server localhost --port 6667 --nick csbot \
+#       --account csbot --account-password secret \
+#       --channels '#a,#b' --admins alice,bob --admin-masks '*!*@staff.example'
+#
+# Admins control the bot by saying "!cs <args>" in a channel; this runs
+# "/cs <args>" in that channel's context. Admins are services accounts
+# (--admins), recognised through the account-tag capability, or hostmasks
+# (--admin-masks); a nick alone is never enough, as anyone can take it.
+#
+# The bot identifies to services as --account (default: its nick) with
+# --account-password: by SASL PLAIN where the server offers it, else with
+# NickServ IDENTIFY once connected. Without that it has no ChanServ access
+# on most networks.
+#
+# This script is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# version 3, as published by the Free Software Foundation.
+
+import argparse
+import asyncio
+import base64
+import collections
+import fnmatch
+import os
+import time
+
+import fakexchat
+
+class XChatShim(fakexchat.FakeXChat):
+    """fakexchat on a real connection: asyncio timers, raw IRC output"""
+    def __init__(self, send, xchatdir, log=print):
+        fakexchat.FakeXChat.__init__(self, xchatdir, nick='', server='')
+        self.send = send
+        self.log = log
+        self.keep_output = False
+
+    def schedule_timer(self, hook):
+        def fire():
+            if hook.callback(hook.userdata):
+                self.schedule_timer(hook)
+            else:
+                hook.handle = None
+        hook.handle = asyncio.get_running_loop().call_later(hook.name / 1000.0, fire)
+
+    def cancel_timer(self, hook):
+        if hook.handle:
+            hook.handle.cancel()
+            hook.handle = None
+
+    def capture(self, context, event, args):
+        if event:
+            self.log('[%s] %s' % (event, ' '.join(str(a) for a in args)))
+        else:
+            self.log(args[0])
+
+    def execute(self, line, context):
+        raw = fakexchat.translate(line)
+        if raw is not None:
+            self.send(raw)
+        elif line.split(' ', 1)[0].lower() != 'set':
+            self.dispatch_command(line, context)
+
+class Bot(object):
+    """An IRC connection driving the script"""
+    def __init__(self, args):
+        self.args = args
+        self.queue = collections.deque()
+        self.wakeup = asyncio.Event()
+        self.writer = None
+        self.admins = set(a.lower() for a in args.admins.split(',') if a)
+        self.admin_masks = [m.lower() for m in args.admin_masks.split(',') if m]
+        self.shim = XChatShim(self.send, args.dir)
+        self.lines_in = self.lines_out = 0
+        # Capabilities asked for and not answered yet, CAP lines for the
+        # script once it is loaded, and whether services know us
+        self.caps_pending = set(['account-tag', 'extended-join', 'account-notify'])
+        if args.account_password:
+            self.caps_pending.add('sasl')
+        self.cap_lines = []
+        self.caps_done = self.identified = False
+
+    def send(self, line):
+        self.queue.append(line)
+        self.wakeup.set()
+
+    def send_now(self, line):
+        self.writer.write((line + '\r\n').encode('utf-8', 'replace'))
+        self.lines_out += 1
+
+    async def pump(self):
+        """Send queued lines through a token bucket"""
+        tokens, last = float(self.args.burst), time.monotonic()
+        while True:
+            if not self.queue:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            now = time.monotonic()
+            tokens = min(self.args.burst, tokens + (now - last) * self.args.rate)
+            last = now
+            if tokens < 1:
+                await asyncio.sleep((1 - tokens) / self.args.rate)
+                continue
+            tokens -= 1
+            self.send_now(self.queue.popleft())
+            await self.writer.drain()
+
+    async def run(self):
+        reader, self.writer = await asyncio.open_connection(self.args.server, self.args.port)
+        if self.args.password:
+            self.send_now('PASS %s' % self.args.password)
+        for cap in sorted(self.caps_pending):
+            self.send_now('CAP REQ :%s' % cap)
+        self.send_now('NICK %s' % self.args.nick)
+        self.send_now('USER %s 0 * :ChanServ helper bot' % self.args.nick)
+        pump = asyncio.ensure_future(self.pump())
+        try:
+            while True:
+                data = await reader.readline()
+                if not data:
+                    break
+                self.handle(data.decode('utf-8', 'replace').rstrip('\r\n'))
+        finally:
+            pump.cancel()
+            self.shim.unload()
+
+    def handle(self, line):
+        self.lines_in += 1
+        tags = {}
+        if line.startswith('@'):
+            raw, _, line = line[1:].partition(' ')
+            for tag in raw.split(';'):
+                key, _, value = tag.partition('=')
+                tags[key] = value
+        if line.startswith('PING'):
+            self.send_now('PONG' + line[4:])
+            return
+        elif line.startswith('AUTHENTICATE +'):
+            account = self.args.account or self.args.nick
+            token = '%s\0%s\0%s' % (account, account, self.args.account_password)
+            self.send_now('AUTHENTICATE %s' % base64.b64encode(token.encode('utf-8')).decode('ascii'))
+            return
+        if not line.startswith(':'):
+            line = ':%s %s' % (self.shim.server or 'server', line)
+        self.shim.dispatch_server(line)
+        word = line.split(' ', 4)
+        if word[1] == 'CAP' and len(word) > 4 and word[3] in ('ACK', 'NAK'):
+            self.cap_lines.append(line)
+            caps = word[4].lstrip(':').split()
+            self.caps_pending.difference_update(caps)
+            if word[3] == 'ACK' and 'sasl' in caps:
+                self.caps_pending.add('sasl')
+                self.send_now('AUTHENTICATE PLAIN')
+            self.end_caps()
+        elif word[1] == '900':
+            self.identified = True
+        elif word[1] in ('902', '903', '904', '905', '906', '908'):
+            # SASL is over, successful or not
+            self.caps_pending.discard('sasl')
+            self.end_caps()
+        elif word[1] == '001':
+            self.caps_done = True
+            self.plugin = fakexchat.load_plugin(self.shim, self.args.script, virtual_time=False)
+            for cap_line in self.cap_lines:
+                self.shim.dispatch_server(cap_line)
+            if self.args.account_password and not self.identified:
+                self.send('PRIVMSG NickServ :IDENTIFY %s %s' % (self.args.account or self.args.nick,
+                                                                self.args.account_password))
+            for channel in self.args.channels.split(','):
+                if channel:
+                    self.send('JOIN %s' % channel)
+        elif word[1] == 'PRIVMSG' and len(word) > 3 and ' '.join(word[3:]).startswith(':!cs '):
+            if word[2][:1] in '#&' and self.is_admin(word[0][1:], tags):
+                self.shim.dispatch_command('cs ' + ' '.join(word[3:])[5:], self.shim.context_for(word[2]))
+
+    def end_caps(self):
+        """Finish capability negotiation once every answer is in"""
+        if not self.caps_pending and not self.caps_done:
+            self.caps_done = True
+            self.send_now('CAP END')
+
+    def is_admin(self, source, tags):
+        """Whether a message comes from an admin: by services account
+        (account-tag), or by hostmask"""
+        account = tags.get('account')
+        if account and account.lower() in self.admins:
+            return True
+        return any(fnmatch.fnmatchcase(source.lower(), mask) for mask in self.admin_masks)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the ChanServ helper script as a standalone bot')
+    parser.add_argument('--server', default='localhost')
+    parser.add_argument('--port', type=int, default=6667)
+    parser.add_argument('--nick', default='csbot')
+    parser.add_argument('--password', default=None)
+    parser.add_argument('--channels', default='', help='comma-separated channels to join')
+    parser.add_argument('--account', default=None, help='services account (default: the nick)')
+    parser.add_argument('--account-password', default=None, help='services password, for SASL or NickServ IDENTIFY')
+    parser.add_argument('--admins', default='', help='comma-separated services accounts allowed to use !cs')
+    parser.add_argument('--admin-masks', default='', help='comma-separated nick!ident@host masks allowed to use !cs')
+    parser.add_argument('--rate', type=float, default=2.0, help='outbound lines per second')
+    parser.add_argument('--burst', type=int, default=5, help='outbound burst size')
+    parser.add_argument('--dir', default=os.path.expanduser('~/.config/csbot'), help='configuration directory')
+    parser.add_argument('--script', default=None, help='path to the script (default: chanserv.1.py)')
+    args = parser.parse_args(argv)
+    if not os.path.isdir(args.dir):
+        os.makedirs(args.dir)
+    bot = Bot(args)
+    try:
+        asyncio.run(bot.run())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
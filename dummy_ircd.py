@@ -0,0 +1,471 @@
+#!/usr/bin/python3
+#
+# Local IRC server and services stand-in for load-testing csbot.py
+#
+# Implements just enough of a charybdis/atheme network for the ChanServ
+# helper script: registration with 005, JOIN/PART/NICK/QUIT, WHOIS/WHOWAS,
+# WHO with WHOX fields, ban and quiet lists, and ChanServ OP/DEOP, AKICK,
+# UNBAN, INVITE and GETKEY, plus NickServ LISTCHANS, and the account-tag
+# and sasl (PLAIN) capabilities. Every client gets founder flags on every
+# channel.
+#
+#   python3 dummy_ircd.py --port 6667 --channels 50 --users 200 --bans 100
+#
+# populates 50 channels (#load0..#load49) with 200 synthetic members and
+# 100 bans each.
+#
+# This script is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# version 3, as published by the Free Software Foundation.
+
+import argparse
+import asyncio
+import base64
+import time
+
+chanserv = 'ChanServ!ChanServ@services.'
+nickserv = 'NickServ!NickServ@services.'
+
+class Client(object):
+    """A connected or synthetic user"""
+    def __init__(self, nick, ident='~user', host='127.0.0.1', name='Dummy user', account='*', writer=None):
+        self.nick = nick
+        self.ident = ident
+        self.host = host
+        self.name = name
+        self.account = account
+        self.writer = writer
+        self.channels = set()
+        self.caps = set()
+        self.registering = None
+
+    @property
+    def mask(self):
+        return '%s!%s@%s' % (self.nick, self.ident, self.host)
+
+    def send(self, line):
+        if self.writer:
+            self.writer.write((line + '\r\n').encode('utf-8', 'replace'))
+
+class Channel(object):
+    def __init__(self, name):
+        self.name = name
+        self.members = {}
+        self.ops = set()
+        self.lists = {'b': [], 'q': []}
+        self.akicks = []
+
+class Server(object):
+    def __init__(self, name):
+        self.name = name
+        self.clients = {}
+        self.channels = {}
+        self.whowas = {}
+
+    def numeric(self, client, num, *args):
+        client.send(':%s %s %s %s' % (self.name, num, client.nick, ' '.join(args)))
+
+    def channel(self, name):
+        key = name.lower()
+        if key not in self.channels:
+            self.channels[key] = Channel(name)
+        return self.channels[key]
+
+    def broadcast(self, channel, line):
+        for member in list(channel.members.values()):
+            member.send(line)
+
+    def populate(self, channels, users, nbans):
+        """Fill channels with synthetic members and bans"""
+        now = int(time.time())
+        for c in range(channels):
+            channel = self.channel('#load%d' % c)
+            for u in range(users):
+                nick = 'u%d_%d' % (c, u)
+                client = Client(nick, '~i%d' % (u % 97), '10.%d.%d.%d' % (c % 256, u // 256, u % 256),
+                                'Synthetic user %d' % u, 'acct%d' % (u % 50) if u % 3 else '*')
+                self.clients[nick.lower()] = client
+                channel.members[nick.lower()] = client
+                client.channels.add(channel.name.lower())
+            for b in range(nbans):
+                channel.lists['b'].append(('*!*@192.0.%d.%d' % (b // 256, b % 256), 'op!op@staff', now - b * 60))
+
+    async def handle(self, reader, writer):
+        client = Client('*', writer=writer)
+        try:
+            while True:
+                data = await reader.readline()
+                if not data:
+                    break
+                self.dispatch(client, data.decode('utf-8', 'replace').rstrip('\r\n'))
+                await writer.drain()
+        finally:
+            self.quit(client, 'Connection closed')
+            writer.close()
+
+    def dispatch(self, client, line):
+        if ' :' in line:
+            head, text = line.split(' :', 1)
+            args = head.split() + [text]
+        else:
+            args = line.split()
+        if not args:
+            return
+        command = args.pop(0).upper()
+        method = getattr(self, 'irc_' + command, None)
+        if method:
+            method(client, args)
+        elif client.nick != '*':
+            self.numeric(client, '421', command, ':Unknown command')
+
+    # Registration
+    def irc_NICK(self, client, args):
+        new = args[0]
+        if new.lower() in self.clients:
+            self.numeric(client, '433', new, ':Nickname is already in use')
+            return
+        old = client.nick
+        self.clients.pop(old.lower(), None)
+        self.clients[new.lower()] = client
+        if old == '*':
+            client.nick = new
+            return
+        mask = client.mask
+        client.nick = new
+        client.send(':%s NICK :%s' % (mask, new))
+        for name in client.channels:
+            channel = self.channels[name]
+            channel.members[new.lower()] = channel.members.pop(old.lower())
+            if old.lower() in channel.ops:
+                channel.ops.discard(old.lower())
+                channel.ops.add(new.lower())
+            for member in channel.members.values():
+                if member is not client:
+                    member.send(':%s NICK :%s' % (mask, new))
+
+    def irc_USER(self, client, args):
+        client.ident = '~' + args[0]
+        client.name = args[-1]
+        if client.account == '*':
+            client.account = client.nick
+        if client.registering is False:
+            # Wait for CAP END
+            client.registering = True
+        else:
+            self.welcome(client)
+
+    def welcome(self, client):
+        self.numeric(client, '001', ':Welcome to the dummy network %s' % client.nick)
+        self.numeric(client, '005', 'CHANTYPES=# EXCEPTS INVEX CHANMODES=eIbq,k,flj,CFLMPQScgimnprstz',
+                     'CHANLIMIT=#:250 PREFIX=(ov)@+ MAXLIST=bqeI:100 MODES=4 NETWORK=dummy',
+                     'STATUSMSG=@+ CASEMAPPING=rfc1459 EXTBAN=$,ajrxz WHOX :are supported by this server')
+        self.numeric(client, '376', ':End of /MOTD command.')
+
+    def irc_CAP(self, client, args):
+        sub = args[0].upper() if args else ''
+        if sub == 'LS':
+            client.send(':%s CAP %s LS :account-tag sasl' % (self.name, client.nick))
+        elif sub == 'END':
+            if client.registering:
+                self.welcome(client)
+            client.registering = None
+        elif sub == 'REQ' and len(args) > 1:
+            if client.registering is None:
+                client.registering = False
+            wanted = args[1].split()
+            if set(wanted) <= set(['account-tag', 'sasl']):
+                client.caps.update(wanted)
+                client.send(':%s CAP %s ACK :%s' % (self.name, client.nick, args[1]))
+            else:
+                client.send(':%s CAP %s NAK :%s' % (self.name, client.nick, args[1]))
+
+    def irc_AUTHENTICATE(self, client, args):
+        if not args or 'sasl' not in client.caps:
+            return
+        elif args[0].upper() == 'PLAIN':
+            client.send('AUTHENTICATE +')
+        else:
+            account = base64.b64decode(args[0]).split(b'\0')[1].decode('utf-8', 'replace')
+            client.account = account
+            self.numeric(client, '900', client.mask, account, ':You are now logged in as %s' % account)
+            self.numeric(client, '903', ':SASL authentication successful')
+
+    def irc_PING(self, client, args):
+        client.send(':%s PONG %s :%s' % (self.name, self.name, args[0] if args else ''))
+
+    def irc_PONG(self, client, args):
+        pass
+
+    def irc_QUIT(self, client, args):
+        self.quit(client, args[0] if args else 'Quit')
+        client.writer.close()
+
+    def quit(self, client, reason):
+        if self.clients.get(client.nick.lower()) is not client:
+            return
+        del self.clients[client.nick.lower()]
+        self.whowas[client.nick.lower()] = client
+        for name in client.channels:
+            channel = self.channels[name]
+            channel.members.pop(client.nick.lower(), None)
+            channel.ops.discard(client.nick.lower())
+            self.broadcast(channel, ':%s QUIT :%s' % (client.mask, reason))
+        client.channels = set()
+
+    # Channels
+    def irc_JOIN(self, client, args):
+        for name in args[0].split(','):
+            channel = self.channel(name)
+            if client.nick.lower() in channel.members:
+                continue
+            channel.members[client.nick.lower()] = client
+            client.channels.add(name.lower())
+            self.broadcast(channel, ':%s JOIN %s' % (client.mask, channel.name))
+            names = [('@' if n in channel.ops else '') + m.nick for n, m in channel.members.items()]
+            for i in range(0, len(names), 50):
+                self.numeric(client, '353', '=', channel.name, ':' + ' '.join(names[i:i + 50]))
+            self.numeric(client, '366', channel.name, ':End of /NAMES list.')
+
+    def irc_PART(self, client, args):
+        for name in args[0].split(','):
+            channel = self.channels.get(name.lower())
+            if not channel or client.nick.lower() not in channel.members:
+                continue
+            self.broadcast(channel, ':%s PART %s :%s' % (client.mask, channel.name, args[1] if len(args) > 1 else ''))
+            del channel.members[client.nick.lower()]
+            channel.ops.discard(client.nick.lower())
+            client.channels.discard(name.lower())
+
+    def kick(self, client, args, verb):
+        channel = self.channels.get(args[0].lower())
+        if not channel:
+            return
+        if client.nick.lower() not in channel.ops:
+            self.numeric(client, '482', channel.name, ":You're not a channel operator")
+            return
+        victim = channel.members.get(args[1].lower())
+        if not victim:
+            self.numeric(client, '441', args[1], channel.name, ":They aren't on that channel")
+            return
+        reason = args[2] if len(args) > 2 else client.nick
+        if verb == 'KICK':
+            self.broadcast(channel, ':%s KICK %s %s :%s' % (client.mask, channel.name, victim.nick, reason))
+        else:
+            self.broadcast(channel, ':%s PART %s :requested by %s (%s)' % (victim.mask, channel.name, client.nick, reason))
+        del channel.members[victim.nick.lower()]
+        channel.ops.discard(victim.nick.lower())
+        victim.channels.discard(channel.name.lower())
+
+    def irc_KICK(self, client, args):
+        self.kick(client, args, 'KICK')
+
+    def irc_REMOVE(self, client, args):
+        self.kick(client, args, 'REMOVE')
+
+    def irc_TOPIC(self, client, args):
+        channel = self.channels.get(args[0].lower())
+        if channel and len(args) > 1:
+            self.broadcast(channel, ':%s TOPIC %s :%s' % (client.mask, channel.name, args[1]))
+
+    def irc_INVITE(self, client, args):
+        target = self.clients.get(args[0].lower())
+        if target:
+            target.send(':%s INVITE %s :%s' % (client.mask, target.nick, args[1]))
+            self.numeric(client, '341', target.nick, args[1])
+
+    def irc_MODE(self, client, args):
+        channel = self.channels.get(args[0].lower())
+        if not channel:
+            if args[0].lower() != client.nick.lower():
+                self.numeric(client, '403', args[0], ':No such channel')
+            return
+        if len(args) == 1:
+            self.numeric(client, '324', channel.name, '+nt')
+            return
+        modes, params = args[1], args[2:]
+        if not params and modes.strip('+') and not modes.strip('+bq'):
+            for char in modes.strip('+'):
+                self.send_list(client, channel, char)
+            return
+        if client.nick.lower() not in channel.ops:
+            self.numeric(client, '482', channel.name, ":You're not a channel operator")
+            return
+        self.apply_modes(client.mask, channel, modes, params)
+
+    def apply_modes(self, source, channel, modes, params):
+        sign, applied, applied_params = '+', '', []
+        params = list(params)
+        for char in modes:
+            if char in '+-':
+                sign = char
+                applied += char
+                continue
+            param = params.pop(0) if char in 'bqov' and params else None
+            if char in 'bq' and param:
+                entries = channel.lists[char]
+                existing = [e for e in entries if e[0].lower() == param.lower()]
+                if sign == '+' and not existing:
+                    entries.append((param, source.split('!')[0], int(time.time())))
+                elif sign == '-' and existing:
+                    entries.remove(existing[0])
+                else:
+                    continue
+            elif char == 'o' and param:
+                if param.lower() not in channel.members:
+                    continue
+                if sign == '+':
+                    channel.ops.add(param.lower())
+                else:
+                    channel.ops.discard(param.lower())
+            applied += char
+            if param:
+                applied_params.append(param)
+        if applied.strip('+-'):
+            self.broadcast(channel, ':%s MODE %s %s' % (source, channel.name, ' '.join([applied] + applied_params)))
+
+    def send_list(self, client, channel, char):
+        if char == 'b':
+            for mask, setter, stamp in channel.lists['b']:
+                self.numeric(client, '367', channel.name, mask, setter, str(stamp))
+            self.numeric(client, '368', channel.name, ':End of Channel Ban List')
+        else:
+            for mask, setter, stamp in channel.lists['q']:
+                self.numeric(client, '728', channel.name, 'q', mask, setter, str(stamp))
+            self.numeric(client, '729', channel.name, 'q', ':End of Channel Quiet List')
+
+    # Queries
+    def irc_WHOIS(self, client, args):
+        nick = args[-1]
+        target = self.clients.get(nick.lower())
+        if not target:
+            self.numeric(client, '401', nick, ':No such nick/channel')
+        else:
+            self.numeric(client, '311', target.nick, target.ident, target.host, '*', ':' + target.name)
+            self.numeric(client, '312', target.nick, self.name, ':Dummy server')
+            if target.account != '*':
+                self.numeric(client, '330', target.nick, target.account, ':is logged in as')
+        self.numeric(client, '318', nick, ':End of /WHOIS list.')
+
+    def irc_WHOWAS(self, client, args):
+        nick = args[0]
+        target = self.whowas.get(nick.lower())
+        if not target:
+            self.numeric(client, '406', nick, ':There was no such nickname')
+        else:
+            self.numeric(client, '314', target.nick, target.ident, target.host, '*', ':' + target.name)
+        self.numeric(client, '369', nick, ':End of WHOWAS')
+
+    def irc_WHO(self, client, args):
+        channel = self.channels.get(args[0].lower())
+        if channel:
+            whox = len(args) > 1 and args[1].startswith('%')
+            for member in list(channel.members.values()):
+                if whox:
+                    self.numeric(client, '354', channel.name, member.ident, member.host, member.nick,
+                                 member.account, ':' + member.name)
+                else:
+                    self.numeric(client, '352', channel.name, member.ident, member.host, self.name,
+                                 member.nick, 'H', ':0 ' + member.name)
+        self.numeric(client, '315', args[0], ':End of /WHO list.')
+
+    # Services
+    def irc_PRIVMSG(self, client, args):
+        target, text = args[0], args[1] if len(args) > 1 else ''
+        if target.lower() == 'chanserv':
+            self.chanserv(client, text.split())
+        elif target.lower() == 'nickserv':
+            self.nickserv(client, text.split())
+        elif target[:1] == '#':
+            channel = self.channels.get(target.lower())
+            if channel:
+                for member in list(channel.members.values()):
+                    if member is not client:
+                        tag = '@account=%s ' % client.account if 'account-tag' in member.caps and client.account != '*' else ''
+                        member.send('%s:%s PRIVMSG %s :%s' % (tag, client.mask, channel.name, text))
+        else:
+            other = self.clients.get(target.lower())
+            if other:
+                other.send(':%s PRIVMSG %s :%s' % (client.mask, other.nick, text))
+
+    def notice(self, source, client, text):
+        client.send(':%s NOTICE %s :%s' % (source, client.nick, text))
+
+    def chanserv(self, client, args):
+        if len(args) < 2:
+            self.notice(chanserv, client, 'Insufficient parameters.')
+            return
+        command, channel = args[0].upper(), self.channels.get(args[1].lower())
+        if not channel:
+            self.notice(chanserv, client, '\x02%s\x02 is not registered.' % args[1])
+            return
+        target = args[2] if len(args) > 2 and command in ('OP', 'DEOP', 'VOICE', 'DEVOICE') else client.nick
+        if command in ('OP', 'DEOP', 'VOICE', 'DEVOICE'):
+            mode = {'OP': '+o', 'DEOP': '-o', 'VOICE': '+v', 'DEVOICE': '-v'}[command]
+            self.apply_modes(chanserv, channel, mode, [target])
+        elif command == 'AKICK' and len(args) > 2:
+            self.akick(client, channel, args[2].upper(), args[3:])
+        elif command == 'UNBAN':
+            self.notice(chanserv, client, 'Unbanned \x02%s\x02 on \x02%s\x02.' % (client.nick, channel.name))
+        elif command == 'INVITE':
+            client.send(':%s INVITE %s :%s' % (chanserv, client.nick, channel.name))
+        elif command == 'GETKEY':
+            self.notice(chanserv, client, 'Channel \x02%s\x02 key is: dummykey' % channel.name)
+        elif command == 'ACCESS':
+            self.notice(chanserv, client, 'Entry Nickname/Host          Flags')
+            self.notice(chanserv, client, '1     %-24s +AFORefiorstv' % client.nick)
+        else:
+            self.notice(chanserv, client, 'Invalid command. Use \x02/msg ChanServ help\x02 for a command listing.')
+
+    def akick(self, client, channel, sub, args):
+        if sub == 'LIST':
+            self.notice(chanserv, client, 'AKICK list for \x02%s\x02:' % channel.name)
+            for i, (mask, reason, setter) in enumerate(channel.akicks):
+                self.notice(chanserv, client, '%d: \x02%s\x02 (%s) [setter: %s, expires: never, modified: 1h ago]' %
+                            (i + 1, mask, reason or 'No reason given', setter))
+            self.notice(chanserv, client, "Total of \x02%d\x02 entries in \x02%s\x02's AKICK list." %
+                        (len(channel.akicks), channel.name))
+        elif sub == 'ADD' and args:
+            mask = args[0] if '!' in args[0] or args[0].startswith('$') else args[0] + '!*@*'
+            channel.akicks.append((mask, ' '.join(a for a in args[1:] if not a.startswith('!')), client.nick))
+            self.notice(chanserv, client, '\x02%s\x02 has been added to the AKICK list for \x02%s\x02.' % (mask, channel.name))
+        elif sub == 'DEL' and args:
+            for entry in channel.akicks:
+                if entry[0].lower() == args[0].lower():
+                    channel.akicks.remove(entry)
+                    self.notice(chanserv, client, '\x02%s\x02 has been removed from the AKICK list for \x02%s\x02.' %
+                                (entry[0], channel.name))
+                    break
+            else:
+                self.notice(chanserv, client, '\x02%s\x02 was not found on the AKICK list for \x02%s\x02.' % (args[0], channel.name))
+
+    def nickserv(self, client, args):
+        if args and args[0].upper() == 'LISTCHANS':
+            for channel in self.channels.values():
+                self.notice(nickserv, client, 'Access flag(s) +AFORefiorstv in %s' % channel.name)
+            self.notice(nickserv, client, '\x02%d\x02 channel access matches for the nickname \x02%s\x02' %
+                        (len(self.channels), client.nick))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local IRC server and services stand-in')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6667)
+    parser.add_argument('--name', default='irc.freenode.local', help='server name')
+    parser.add_argument('--channels', type=int, default=0, help='number of synthetic channels')
+    parser.add_argument('--users', type=int, default=0, help='synthetic members per channel')
+    parser.add_argument('--bans', type=int, default=0, help='synthetic bans per channel')
+    args = parser.parse_args(argv)
+
+    server = Server(args.name)
+    server.populate(args.channels, args.users, args.bans)
+
+    async def serve():
+        listener = await asyncio.start_server(server.handle, args.host, args.port)
+        async with listener:
+            await listener.serve_forever()
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,420 @@
+#
+# In-process stand-in for XChat's xchat module
+#
+# Provides what the ChanServ helper script uses: channel contexts with
+# get_info() and get_list('users'), hook_server/hook_command dispatch with
+# XChat's word and word_eol lists, hook_timer on a virtual clock, and
+# capture of command(), emit_print() and prnt() output. Rosters, our nick
+# and the server name are tracked from the lines fed in, like XChat does.
+#
+#   import fakexchat
+#   xchat = fakexchat.FakeXChat()
+#   cs = fakexchat.load_plugin(xchat)
+#   xchat.dispatch_server(':irc.freenode.net 001 me :Welcome')
+#   xchat.dispatch_command('cs ban nick', xchat.context_for('#channel'))
+#   xchat.advance(60)
+#   print(xchat.sent, xchat.printed)
+#
+# This script is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# version 3, as published by the Free Software Foundation.
+
+import heapq
+import importlib.util
+import os
+import sys
+import time
+import types
+
+EAT_NONE = 0
+EAT_XCHAT = 1
+EAT_PLUGIN = 2
+EAT_ALL = 3
+
+# XChat command -> raw IRC verb, for commands whose arguments pass through
+raw_verbs = {'mode': 'MODE', 'whois': 'WHOIS', 'whowas': 'WHOWAS', 'who': 'WHO',
+             'join': 'JOIN', 'part': 'PART', 'invite': 'INVITE', 'nick': 'NICK',
+             'names': 'NAMES', 'away': 'AWAY'}
+# Commands whose last argument is free text
+text_verbs = {'kick': ('KICK', 2), 'remove': ('REMOVE', 2), 'topic': ('TOPIC', 1)}
+services = {'chanserv': 'ChanServ', 'cs': 'ChanServ', 'nickserv': 'NickServ', 'ns': 'NickServ'}
+
+def split_line(line):
+    """Split a line into XChat's word and word_eol lists"""
+    word = line.split(' ')
+    word_eol = []
+    pos = 0
+    for w in word:
+        word_eol.append(line[pos:])
+        pos += len(w) + 1
+    return word, word_eol
+
+def translate(line):
+    """Translate an XChat command into a raw IRC line, or None if it is not one"""
+    verb, _, rest = line.strip().partition(' ')
+    verb = verb.lower()
+    if verb in ('quote', 'raw'):
+        return rest
+    elif verb in services:
+        return 'PRIVMSG %s :%s' % (services[verb], rest)
+    elif verb in ('msg', 'privmsg', 'notice'):
+        target, _, text = rest.partition(' ')
+        return '%s %s :%s' % ('NOTICE' if verb == 'notice' else 'PRIVMSG', target, text)
+    elif verb in text_verbs:
+        irc_verb, nargs = text_verbs[verb]
+        args = rest.split(' ', nargs)
+        if len(args) > nargs:
+            args[nargs] = ':' + args[nargs]
+        return ' '.join([irc_verb] + args)
+    elif verb in raw_verbs:
+        return ('%s %s' % (raw_verbs[verb], rest)).strip()
+    return None
+
+class Hook(object):
+    def __init__(self, kind, name, callback, userdata):
+        self.kind = kind
+        self.name = name
+        self.callback = callback
+        self.userdata = userdata
+        self.handle = None
+
+class Member(object):
+    """An entry of get_list('users')"""
+    def __init__(self, nick, prefix=''):
+        self.nick = nick
+        self.prefix = prefix
+        self.host = ''
+        self.account = ''
+        self.realname = ''
+        self.away = 0
+        self.lasttalk = 0
+        self.selected = 0
+
+class Context(object):
+    """A server or channel tab"""
+    def __init__(self, xchat, channel):
+        self.xchat = xchat
+        self.channel = channel
+        self.members = {}
+
+    @property
+    def context(self):
+        return self
+
+    def get_info(self, key):
+        if key == 'channel':
+            return self.channel or self.xchat.server
+        return self.xchat.get_info(key)
+
+    def get_list(self, key):
+        if key == 'users':
+            return list(self.members.values())
+        return self.xchat.get_list(key)
+
+    def command(self, line):
+        self.xchat.execute(line, self)
+
+    def emit_print(self, event, *args):
+        self.xchat.capture(self, event, args)
+
+    def prnt(self, text):
+        self.xchat.capture(self, None, (text,))
+
+    def set(self):
+        self.xchat.current = self
+
+    def __eq__(self, other):
+        return self is other
+
+    __hash__ = object.__hash__
+
+class VirtualTime(object):
+    """Replacement for the time module that reads the virtual clock"""
+    def __init__(self, xchat):
+        self.xchat = xchat
+
+    def time(self):
+        return self.xchat.now
+
+    def ctime(self, secs=None):
+        return time.ctime(self.xchat.now if secs is None else secs)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+class FakeXChat(types.ModuleType):
+    """The subset of the xchat module used by the script"""
+    EAT_NONE = EAT_NONE
+    EAT_XCHAT = EAT_XCHAT
+    EAT_PLUGIN = EAT_PLUGIN
+    EAT_ALL = EAT_ALL
+    PRI_HIGHEST, PRI_HIGH, PRI_NORM, PRI_LOW, PRI_LOWEST = 127, 64, 0, -64, -128
+
+    def __init__(self, xchatdir=None, nick='me', server='irc.freenode.net', now=1000000000.0):
+        types.ModuleType.__init__(self, 'xchat')
+        self.xchatdir = xchatdir or os.getcwd()
+        self.nick = nick
+        self.server = server
+        self.network = ''
+        self.hooks = {}
+        self.unload_hooks = []
+        self.server_context = Context(self, None)
+        self.contexts = {}
+        self.current = self.server_context
+        # Virtual clock and pending timers
+        self.now = now
+        self.timers = []
+        self.timer_seq = 0
+        # Captured output
+        self.sent = []
+        self.printed = []
+        self.wire = None
+        self.keep_output = True
+        # Per-hook [calls, seconds] when profiling is enabled
+        self.hook_times = None
+
+    # Hooks
+    def hook_server(self, name, callback, userdata=None, priority=0):
+        hook = Hook('server', name.upper(), callback, userdata)
+        self.hooks.setdefault(hook.name, []).append(hook)
+        return hook
+
+    def hook_command(self, name, callback, userdata=None, priority=0, help=None):
+        hook = Hook('command', '/' + name.upper(), callback, userdata)
+        self.hooks.setdefault(hook.name, []).append(hook)
+        return hook
+
+    def hook_print(self, name, callback, userdata=None, priority=0):
+        hook = Hook('print', 'print:' + name, callback, userdata)
+        self.hooks.setdefault(hook.name, []).append(hook)
+        return hook
+
+    def hook_unload(self, callback, userdata=None):
+        hook = Hook('unload', None, callback, userdata)
+        self.unload_hooks.append(hook)
+        return hook
+
+    def hook_timer(self, timeout, callback, userdata=None):
+        hook = Hook('timer', timeout, callback, userdata)
+        self.schedule_timer(hook)
+        return hook
+
+    def schedule_timer(self, hook):
+        self.timer_seq += 1
+        hook.handle = (self.now + hook.name / 1000.0, self.timer_seq, hook)
+        heapq.heappush(self.timers, hook.handle)
+
+    def cancel_timer(self, hook):
+        hook.handle = None
+
+    def unhook(self, hook):
+        if hook.kind == 'timer':
+            self.cancel_timer(hook)
+        elif hook.kind == 'unload':
+            self.unload_hooks.remove(hook)
+        elif hook in self.hooks.get(hook.name, []):
+            self.hooks[hook.name].remove(hook)
+
+    def advance(self, seconds):
+        """Move the virtual clock forward, firing due timers in order"""
+        end = self.now + seconds
+        while self.timers and self.timers[0][0] <= end:
+            entry = heapq.heappop(self.timers)
+            hook = entry[2]
+            if hook.handle is not entry:
+                continue
+            self.now = entry[0]
+            if hook.callback(hook.userdata):
+                self.schedule_timer(hook)
+            else:
+                hook.handle = None
+        self.now = end
+
+    # Information
+    def get_info(self, key):
+        if key == 'nick':
+            return self.nick
+        elif key in ('server', 'host'):
+            return self.server
+        elif key == 'network':
+            return self.network
+        elif key in ('xchatdir', 'configdir'):
+            return self.xchatdir
+        elif key == 'channel':
+            return self.current.get_info('channel')
+        elif key == 'version':
+            return '2.9.6'
+
+    def get_list(self, key):
+        if key == 'channels':
+            return [types.SimpleNamespace(channel=c.channel, server=self.server, network=self.network,
+                                          context=c, type=2, users=len(c.members))
+                    for c in self.contexts.values()]
+        elif key == 'users':
+            return self.current.get_list('users')
+        return []
+
+    def get_context(self):
+        return self.current
+
+    def find_context(self, server=None, channel=None):
+        if channel is None:
+            return self.server_context
+        return self.contexts.get(channel.lower())
+
+    def context_for(self, channel):
+        key = channel.lower()
+        if key not in self.contexts:
+            self.contexts[key] = Context(self, channel)
+        return self.contexts[key]
+
+    def add_channel(self, channel, members=(), op=False):
+        """Create a channel tab we are in, with the given nicks"""
+        context = self.context_for(channel)
+        context.members[self.nick.lower()] = Member(self.nick, '@' if op else '')
+        for nick in members:
+            prefix = nick[0] if nick[0] in '@+' else ''
+            context.members[nick[len(prefix):].lower()] = Member(nick[len(prefix):], prefix)
+        return context
+
+    # Output
+    def capture(self, context, event, args):
+        if self.keep_output:
+            self.printed.append((context.channel, event, args))
+
+    def emit_print(self, event, *args):
+        self.capture(self.current, event, args)
+
+    def prnt(self, text):
+        self.capture(self.current, None, (text,))
+
+    def command(self, line):
+        self.execute(line, self.current)
+
+    def execute(self, line, context):
+        """Record a command; pass raw IRC on to the wire, if any"""
+        raw = translate(line)
+        if raw is None:
+            if line.split(' ', 1)[0].lower() != 'set':
+                self.dispatch_command(line, context)
+            return
+        if self.keep_output:
+            self.sent.append((context.channel, line))
+        if self.wire:
+            self.wire(raw)
+
+    # Input
+    def dispatch_command(self, line, context=None):
+        """Run a /command through the command hooks"""
+        previous = self.current
+        if context:
+            self.current = context
+        word, word_eol = split_line(line.strip())
+        self.run_hooks('/' + word[0].upper(), word, word_eol)
+        self.current = previous
+
+    def dispatch_server(self, line):
+        """Run the server hooks on a raw line, then update state from it"""
+        word, word_eol = split_line(line)
+        if len(word) < 2:
+            return
+        command = word[1].upper()
+        if len(word) > 2 and word[2][:1] in '#&':
+            self.current = self.context_for(word[2].lstrip(':'))
+        elif len(word) > 3 and word[3][:1] in '#&':
+            self.current = self.context_for(word[3])
+        else:
+            self.current = self.server_context
+        # Like XChat, run the hooks before updating the user lists
+        self.run_hooks(command, word, word_eol)
+        self.track(word, command)
+        self.current = self.server_context
+
+    def run_hooks(self, name, word, word_eol):
+        for hook in list(self.hooks.get(name, [])):
+            if self.hook_times is None:
+                result = hook.callback(word, word_eol, hook.userdata)
+            else:
+                start = time.perf_counter()
+                result = hook.callback(word, word_eol, hook.userdata)
+                key = '%s %s' % (name, getattr(hook.callback, '__name__', '?'))
+                entry = self.hook_times.setdefault(key, [0, 0.0])
+                entry[0] += 1
+                entry[1] += time.perf_counter() - start
+            if result == EAT_ALL:
+                break
+
+    def track(self, word, command):
+        """Keep nick, server and channel rosters current"""
+        source = word[0][1:].split('!', 1)[0]
+        if command == '001':
+            self.nick = word[2]
+            self.server = word[0][1:]
+        elif command == '005':
+            for token in word[3:]:
+                if token.startswith('NETWORK='):
+                    self.network = token[8:]
+        elif command == 'JOIN':
+            channel = word[2].lstrip(':')
+            context = self.context_for(channel)
+            if source == self.nick:
+                context.members = {}
+            context.members[source.lower()] = Member(source)
+        elif command in ('PART', 'KICK'):
+            nick = source if command == 'PART' else word[3]
+            if nick == self.nick:
+                self.contexts.pop(word[2].lower(), None)
+            else:
+                self.context_for(word[2]).members.pop(nick.lower(), None)
+        elif command == 'QUIT':
+            for context in self.contexts.values():
+                context.members.pop(source.lower(), None)
+        elif command == 'NICK':
+            new = word[2].lstrip(':')
+            if source == self.nick:
+                self.nick = new
+            for context in self.contexts.values():
+                member = context.members.pop(source.lower(), None)
+                if member:
+                    member.nick = new
+                    context.members[new.lower()] = member
+        elif command == '353':
+            context = self.context_for(word[4])
+            for name in [word[5].lstrip(':')] + word[6:]:
+                if not name:
+                    continue
+                prefix = name[0] if name[0] in '@+%~&' else ''
+                nick = name[len(prefix):]
+                context.members[nick.lower()] = Member(nick, prefix)
+        elif command == 'MODE' and word[2][:1] in '#&':
+            context = self.context_for(word[2])
+            sign, args = '+', word[4:]
+            for char in word[3]:
+                if char in '+-':
+                    sign = char
+                elif char in 'ov':
+                    member = context.members.get(args.pop(0).lower()) if args else None
+                    if member:
+                        prefix = '@' if char == 'o' else '+'
+                        if sign == '+':
+                            member.prefix = prefix if prefix == '@' or not member.prefix else member.prefix
+                        elif member.prefix == prefix:
+                            member.prefix = ''
+                elif char in 'beIqkfjl' and args and (sign == '+' or char not in 'lj'):
+                    args.pop(0)
+
+    def unload(self):
+        for hook in self.unload_hooks[:]:
+            hook.callback(hook.userdata)
+
+def load_plugin(xchat, path=None, virtual_time=True):
+    """Load the script with xchat installed as the xchat module"""
+    if not path:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chanserv.1.py')
+    sys.modules['xchat'] = xchat
+    spec = importlib.util.spec_from_file_location('chanserv', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    if virtual_time:
+        module.time = VirtualTime(xchat)
+    return module
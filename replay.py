@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+#
+# Replay IRC transcripts through the ChanServ helper script
+#
+# Loads chanserv.1.py on top of fakexchat and feeds it a transcript, timing
+# every hook on the wall clock while the script itself runs on fakexchat's
+# virtual clock, so results are repeatable. Transcript lines are
+#
+#   [seconds] :prefix COMMAND args      a line from the server
+#   [seconds] [#channel] /command args  a command typed in a tab
+#   # comment
+#
+# where the optional seconds move the virtual clock to that offset from the
+# start. With --serve, an in-process dummy_ircd answers everything the
+# script sends, so a transcript can consist of commands only.
+#
+#   python3 replay.py --serve session.txt
+#
+# This script is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# version 3, as published by the Free Software Foundation.
+
+import argparse
+import collections
+import re
+import time
+
+import fakexchat
+
+_timestamp = re.compile(r'^\+?([0-9]+(?:\.[0-9]*)?)\s+(.*)$')
+
+class Pipe(object):
+    """Writer end of an in-process connection, collecting lines"""
+    def __init__(self, queue):
+        self.queue = queue
+
+    def write(self, data):
+        for line in data.decode('utf-8', 'replace').split('\r\n'):
+            if line:
+                self.queue.append(line)
+
+    def close(self):
+        pass
+
+class Replay(object):
+    """The script on a fake xchat, optionally connected to a dummy ircd"""
+    def __init__(self, script=None, serve=False, nick='me', server='irc.freenode.net', profile=True):
+        self.xchat = fakexchat.FakeXChat(nick=nick, server=server)
+        if profile:
+            self.xchat.hook_times = {}
+        self.start = self.xchat.now
+        self.inbound = collections.deque()
+        self.lines_in = 0
+        self.ircd = None
+        if serve:
+            import dummy_ircd
+            self.ircd = dummy_ircd.Server(server)
+            self.client = dummy_ircd.Client('*', writer=Pipe(self.inbound))
+            self.xchat.wire = lambda raw: self.ircd.dispatch(self.client, raw)
+        self.plugin = fakexchat.load_plugin(self.xchat, script)
+        if serve:
+            self.ircd.dispatch(self.client, 'NICK %s' % nick)
+            self.ircd.dispatch(self.client, 'USER %s 0 * :Replay' % nick)
+            self.drain()
+
+    def drain(self):
+        """Feed server replies until there are none left"""
+        while self.inbound:
+            self.server(self.inbound.popleft())
+
+    def server(self, line):
+        self.lines_in += 1
+        self.xchat.dispatch_server(line)
+
+    def command(self, line, channel=None):
+        context = self.xchat.context_for(channel) if channel else self.xchat.server_context
+        verb = line.lstrip('/').split(' ', 1)[0].upper()
+        if '/' + verb in self.xchat.hooks:
+            self.xchat.dispatch_command(line.lstrip('/'), context)
+        else:
+            self.xchat.execute(line.lstrip('/'), context)
+
+    def feed(self, line):
+        """Process one transcript line"""
+        line = line.rstrip('\r\n')
+        if not line.strip() or line.startswith('# '):
+            return
+        match = _timestamp.match(line)
+        if match:
+            offset, line = float(match.group(1)), match.group(2)
+            if self.start + offset > self.xchat.now:
+                self.xchat.advance(self.start + offset - self.xchat.now)
+        if line.startswith(':'):
+            self.server(line)
+        elif line.startswith('/'):
+            self.command(line)
+        else:
+            channel, _, rest = line.partition(' ')
+            self.command(rest, channel)
+        self.drain()
+
+    def run(self, lines):
+        """Replay lines and return the wall time it took"""
+        start = time.perf_counter()
+        for line in lines:
+            self.feed(line)
+        return time.perf_counter() - start
+
+    def report(self, elapsed, out=print):
+        out('%d lines in %.3fs (%.0f lines/s), %d commands sent, %d lines printed' %
+            (self.lines_in, elapsed, self.lines_in / elapsed if elapsed else 0,
+             len(self.xchat.sent), len(self.xchat.printed)))
+        if self.xchat.hook_times:
+            out('%-28s %8s %10s %8s' % ('hook', 'calls', 'total ms', 'us/call'))
+            for key, (calls, seconds) in sorted(self.xchat.hook_times.items(), key=lambda x: -x[1][1]):
+                out('%-28s %8d %10.2f %8.1f' % (key, calls, seconds * 1000, seconds * 1e6 / calls))
+        latencies = getattr(self.plugin, 'latencies', None)
+        if latencies and sum(latencies):
+            bounds = ['<=%gs' % b for b in self.plugin.latency_buckets] + ['>%gs' % self.plugin.latency_buckets[-1]]
+            out('action latency (virtual): ' + ', '.join('%s: %d' % x for x in zip(bounds, latencies) if x[1]))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay an IRC transcript through the script')
+    parser.add_argument('transcript', nargs='+')
+    parser.add_argument('--serve', action='store_true', help='answer commands with an in-process dummy ircd')
+    parser.add_argument('--script', default=None, help='path to the script (default: chanserv.1.py)')
+    parser.add_argument('--nick', default='me')
+    parser.add_argument('--server', default='irc.freenode.net')
+    parser.add_argument('--verbose', action='store_true', help='print what the script printed and sent')
+    args = parser.parse_args(argv)
+
+    replay = Replay(args.script, serve=args.serve, nick=args.nick, server=args.server)
+    lines = []
+    for path in args.transcript:
+        with open(path) as fd:
+            lines.extend(fd.readlines())
+    elapsed = replay.run(lines)
+    if args.verbose:
+        for channel, line in replay.xchat.sent:
+            print('>> %s %s' % (channel or '-', line))
+        for channel, event, text in replay.xchat.printed:
+            print('<< %s [%s] %s' % (channel or '-', event, ' '.join(str(t) for t in text)))
+    replay.report(elapsed)
+
+if __name__ == '__main__':
+    main()